@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of the macro_transforms rewrite that runs before tokenizing, with the
+# old recompile-and-search loop for comparison. Run from the repository root:
+#
+#   python3 -m benchmarks.bench_rewrite [--file utils/item_list.cfg]
+
+import argparse
+import random
+import re
+import time
+
+from loti_wiki_gen import wml_parser
+
+from . import corpus
+
+
+def legacy_rewrite(text):
+    macro_transforms = [
+        (r"\"\s*\+\s*\{([^}]*)\}\s*\+\s*_?\s*\"", "\\1"),
+        (r"\{([^}]*)\}\s*\+\s*_?\s*\"", '"\\1'),
+        (r"\"\s*\+\s*\{([^}]*)\}", '\\1"'),
+        (r"\"\s*\+\s*(\d+)", '\\1"'),
+        (r"\"\s*\+\s*_?\s*\"", ""),
+        (r"\"\s*\+\s*\$(\S+)", '\\1"'),
+        (r"<<(.*?)>>+", '"\1"'),
+    ]
+    for regex, sub in macro_transforms:
+        regex = re.compile(regex, re.MULTILINE + re.DOTALL)
+        while regex.search(text):
+            text = regex.sub(sub, text)
+    return text
+
+
+def timed(func, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [func(text) for text in texts]
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the macro rewrite pass")
+    parser.add_argument("--file", action="append", help="WML file to use instead of the synthetic inputs")
+    parser.add_argument("--items", type=int, default=3000, help="Size of the synthetic item list")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if args.file:
+        cases = [(f, [open(f, encoding="utf-8").read()]) for f in args.file]
+    else:
+        cases = [
+            ("item_list.cfg", [corpus.item_list(rng, args.items)]),
+            ("100 unit files", [corpus.unit(rng, i) for i in range(100)]),
+        ]
+
+    for name, texts in cases:
+        size = sum(map(len, texts)) / 1024
+        before, expected = timed(legacy_rewrite, texts, args.repeat)
+        data = [text.encode("utf-8") for text in texts]
+        after, result = timed(wml_parser.rewrite_macros, data, args.repeat)
+        assert [r.decode("utf-8") for r in result] == expected, "rewrite_macros does not reach the same fixed point"
+        print("{} ({:.1f} KiB)".format(name, size))
+        print("    before: {:8.2f} ms".format(before * 1000))
+        print("    after:  {:8.2f} ms ({:.1f}x)".format(after * 1000, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Time the extractors with their select= filters, and the items streamed
+# by iterparse, against full parses, and check that the pages written from
+# both are identical. Run from the
+# repository root:
+#
+#   python3 -m benchmarks.bench_select [LotI path]
+
+import argparse
+import contextlib
+import io
+import pathlib
+import tempfile
+import time
+
+from loti_wiki_gen import extractor, graph, index, wml_parser, writer
+
+from . import corpus
+
+
+@contextlib.contextmanager
+def unfiltered():
+    parse = wml_parser.parse
+
+    def full_parse(source, *args, select=None, **kwargs):
+        return parse(source, *args, **kwargs)
+
+    wml_parser.parse = full_parse
+    try:
+        yield
+    finally:
+        wml_parser.parse = parse
+
+
+def parsed_items(start):
+    # The objects extract_items streams from iterparse, taken from a full
+    # parse of the file instead
+    data = wml_parser.parse(start / "utils" / "item_list.cfg")
+    for tag in data.tags["ITEM_LIST"][0].tags["object"]:
+        if "name" in tag.keys and "filter" not in tag.tags:
+            yield tag.keys["name"].any, tag
+
+
+def extract(start, items=extractor.extract_items):
+    times = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        abilities = list(extractor.extract_abilities(start))
+        standard = list(extractor.extract_standard_advancements(start / "utils" / "amla.cfg"))
+        for name, func, arg in [
+            ("units", extractor.extract_unit_advancements, start / "units"),
+            ("items", items, start),
+            ("scenarios", extractor.extract_scenarios, start),
+        ]:
+            begin = time.process_time()
+            times[name] = list(func(arg)), time.process_time() - begin
+    return abilities, standard, times
+
+
+def render(abilities, standard, times):
+    units, items, scenarios = (times[name][0] for name in ("units", "items", "scenarios"))
+    out = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        idx = index.Index(index.advancement_names(units, standard), index.ability_names(abilities), index.item_names(items))
+        links = index.Links(idx, "benchmark", graph.Graph(units))
+        for adv in units:
+            writer.write_advancement(*adv[:-1], out, links)
+        for item in items:
+            writer.write_item(*item, out, links)
+        for scenario in scenarios:
+            writer.write_scenario(*scenario, out)
+        links.resolve()
+    return links.sub(out.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extractors' select filters")
+    parser.add_argument("dir", nargs="?", help="LotI root, a synthetic tree is generated if omitted")
+    parser.add_argument("--scale", type=float, default=4.0, help="Size of the synthetic tree")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    best = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        start = pathlib.Path(args.dir) if args.dir else corpus.make_tree(pathlib.Path(tmp) / "loti", args.scale)
+        for _ in range(args.repeat):
+            with unfiltered():
+                full = extract(start, parsed_items)
+            filtered = extract(start)
+            assert render(*full) == render(*filtered), "select or iterparse changes the extracted results"
+            for name in full[2]:
+                times = full[2][name][1], filtered[2][name][1]
+                best[name] = tuple(map(min, zip(best.get(name, times), times)))
+
+    for name, (before, after) in best.items():
+        print("{:10} full: {:8.2f} ms  select: {:8.2f} ms ({:.1f}x)".format(name, before * 1000, after * 1000, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Synthetic LotI-shaped WML, used by the benchmarks when a real LotI checkout
+# is not available. The shapes (defines, #ifdef difficulty blocks, string
+# concatenation, AMLA wrappers, ...) follow what the generator meets in LotI.
+
+import argparse
+import pathlib
+import random
+
+WORDS = (
+    "shadow storm iron frost blood ember silent ancient golden black thorn "
+    "wrath dawn dusk bone star void tide ash grim pale holy vile swift"
+).split()
+
+WEAPON_SORTS = ["sword", "axe", "bow", "mace", "xbow", "spear", "dagger", "staff"]
+OTHER_SORTS = ["armour", "helm", "ring", "amulet", "cloak", "boots", "gauntlets"]
+GEMS = [
+    "obsidians", "topazes", "opals", "pearls", "diamonds",
+    "rubies", "emeralds", "amethysts", "sapphires", "black_pearls",
+]
+DAMAGE_TYPES = ["blade", "impact", "pierce", "fire", "cold", "arcane"]
+TERRAINS = ["forest", "flat", "hills", "mountains", "village", "castle", "cave"]
+SPECIALS = ["MAGICAL", "MARKSMAN", "POISON", "SLOW", "DRAIN", "FIRSTSTRIKE"]
+ABILITIES = ["REGENERATES", "SKIRMISHER", "TELEPORT", "STEADFAST", "NIGHTSTALK"]
+
+
+def title(rng, n=2):
+    return " ".join(rng.choice(WORDS).title() for _ in range(n))
+
+
+def sentence(rng, n=12):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def effect(rng, indent):
+    pad = " " * indent
+    kind = rng.randrange(7)
+    if kind == 0:
+        body = [
+            "apply_to=attack",
+            "range=" + rng.choice(["melee", "ranged"]),
+            "increase_damage={}".format(rng.randint(1, 5)),
+        ]
+    elif kind == 1:
+        body = ["apply_to=hitpoints", "increase_total={}".format(rng.randint(2, 20))]
+    elif kind == 2:
+        body = ["apply_to=movement", "increase={}".format(rng.choice([1, -1, 2]))]
+    elif kind == 3:
+        body = [
+            "apply_to=defense",
+            "[defense]",
+            "    {}={}".format(rng.choice(TERRAINS), -rng.randint(1, 10)),
+            "[/defense]",
+        ]
+    elif kind == 4:
+        body = [
+            "apply_to=resistance",
+            "[resistance]",
+            "    {},{}=-{},-{}".format(*rng.sample(DAMAGE_TYPES, 2), *[rng.randint(1, 5)] * 2),
+            "[/resistance]",
+        ]
+    elif kind == 5:
+        body = [
+            "apply_to=attack",
+            "[set_specials]",
+            "    mode=append",
+            "    {{WEAPON_SPECIAL_{}}}".format(rng.choice(SPECIALS)),
+            "[/set_specials]",
+        ]
+    else:
+        body = [
+            "apply_to=new_ability",
+            "[abilities]",
+            "    {{ABILITY_{}}}".format(rng.choice(ABILITIES)),
+            "[/abilities]",
+        ]
+    return "\n".join(
+        [pad + "[effect]"] + [pad + "    " + line for line in body] + [pad + "[/effect]"]
+    )
+
+
+def noise(rng, indent):
+    # Subtrees that the extractors never look at, as found in real unit files
+    pad = " " * indent
+    lines = [
+        pad + "[attack]",
+        pad + "    name=" + rng.choice(WORDS),
+        pad + "    description= _ \"" + rng.choice(WORDS) + "\"",
+        pad + "    type=" + rng.choice(DAMAGE_TYPES),
+        pad + "    range=melee",
+        pad + "    damage,number={},{}".format(rng.randint(5, 30), rng.randint(1, 5)),
+        pad + "    [specials]",
+        pad + "        {{WEAPON_SPECIAL_{}}}".format(rng.choice(SPECIALS)),
+        pad + "    [/specials]",
+        pad + "[/attack]",
+        pad + "[attack_anim]",
+        pad + "    [filter_attack]",
+        pad + "        name=" + rng.choice(WORDS),
+        pad + "    [/filter_attack]",
+        pad + "    [frame]",
+        pad + "        image=\"units/{}.png~CROP(0,0,72,72)\"".format(rng.choice(WORDS)),
+        pad + "        duration=100",
+        pad + "    [/frame]",
+        pad + "[/attack_anim]",
+    ]
+    return "\n".join(lines)
+
+
+def item(rng, i, names):
+    name = "{} of {} {}".format(rng.choice(["Sword", "Ring", "Helm", "Cloak", "Bow"]), title(rng), i)
+    crafted = rng.random() < 0.1
+    sort = "weaponword" if crafted else rng.choice(WEAPON_SORTS + OTHER_SORTS)
+    lines = [
+        "    [object]",
+        "        name= _ \"{}\"".format(name),
+        "        number={}".format(i),
+        "        sort=" + sort,
+        "        image=items/{}.png".format(rng.choice(WORDS)),
+        "        flavour= _ \"{}\"".format(sentence(rng)),
+    ]
+    if sort in WEAPON_SORTS or crafted:
+        lines.append("        damage={}".format(rng.randint(5, 40)))
+        lines.append("        attacks={}".format(rng.randint(-10, 20)))
+        lines.append("        [specials]")
+        lines.append("            {{WEAPON_SPECIAL_{}}}".format(rng.choice(SPECIALS)))
+        lines.append("        [/specials]")
+    else:
+        lines.append("        defence={}".format(rng.randint(1, 15)))
+    if rng.random() < 0.5:
+        a, b = rng.sample(DAMAGE_TYPES, 2)
+        lines.append("        {}_resist,{}_resist={},{}".format(a, b, rng.randint(1, 20), rng.randint(1, 20)))
+    if rng.random() < 0.2:
+        lines.append("#ifdef EASY")
+        lines.append("        magic=15")
+        lines.append("#else")
+        lines.append("        magic=10")
+        lines.append("#endif")
+    if rng.random() < 0.2:
+        lines.append("        {{QUANTITY dodge {} {} {}}}".format(*sorted(rng.sample(range(1, 20), 3), reverse=True)))
+    if crafted:
+        for gem in GEMS:
+            lines.append("        {}={}".format(gem, rng.choice(["0", "0", "1", "2"]) if gem != "rubies" else "1"))
+    for _ in range(rng.randint(0, 2)):
+        lines.append(effect(rng, 8))
+    if rng.random() < 0.15:
+        lines.append("        [latent]")
+        lines.append("            desc= _ \"Bonus (requires {})\"".format(rng.choice(names or [name])))
+        lines.append("            apply_to=hitpoints")
+        lines.append("            increase_total=5")
+        lines.append("        [/latent]")
+    if rng.random() < 0.15:
+        lines.append("        description= _ \"Deals \" + {{BONUS_{}}} + _ \" more\" + \" damage at night\"".format(i))
+    if rng.random() < 0.1:
+        lines.append("        [filter]")
+        lines.append("            race=undead")
+        lines.append("        [/filter]")
+    if rng.random() < 0.1:
+        lines.append("        [event]")
+        lines.append("            name=attack_end")
+        lines.append("            [lua]")
+        lines.append("                code=<< local u = wesnoth.get_unit(1, 2)")
+        lines.append("                    if u then u.hitpoints = u.hitpoints + 1 end >>")
+        lines.append("            [/lua]")
+        lines.append("        [/event]")
+    lines.append("    [/object]")
+    return "\n".join(lines)
+
+
+def item_list(rng, count):
+    parts = ["#textdomain wesnoth-loti", "", "#define ITEM_LIST"]
+    names = []
+    for i in range(count):
+        parts.append(item(rng, i, names))
+        names.append(parts[-1].split('"')[1])
+        if i % 97 == 0:
+            parts.append("#ifver WESNOTH_VERSION >= 1.14.0")
+            parts.append("    [object]")
+            parts.append("        name= _ \"Versioned {}\"".format(i))
+            parts.append("        sort=ring")
+            parts.append("    [/object]")
+            parts.append("#else")
+            parts.append("    [object]")
+            parts.append("        name= _ \"Old Versioned {}\"".format(i))
+            parts.append("        sort=ring")
+            parts.append("    [/object]")
+            parts.append("#endif")
+    parts.append("#enddef")
+    return "\n".join(parts) + "\n"
+
+
+def advancement(rng, id, previous, indent=4):
+    pad = " " * indent
+    lines = [
+        pad + "[advancement]",
+        pad + "    id=" + id,
+        pad + "    description= _ \"{}\"".format(sentence(rng, 4)[:-1].lower()),
+        pad + "    image=attacks/{}.png".format(rng.choice(WORDS)),
+        pad + "    max_times={}".format(rng.choice([1, 1, 2, 5, 10])),
+        pad + "    always_display=yes",
+    ]
+    if previous:
+        lines.append(pad + "    require_amla=" + ",".join(previous))
+    for _ in range(rng.randint(1, 3)):
+        lines.append(effect(rng, indent + 4))
+    lines.append(pad + "[/advancement]")
+    return "\n".join(lines)
+
+
+def advancements(rng, prefix, count, indent=4):
+    out = []
+    ids = []
+    for i in range(count):
+        id = "{}{}".format(prefix, i)
+        out.append(advancement(rng, id, rng.sample(ids, min(len(ids), rng.randint(0, 2))), indent))
+        ids.append(id)
+    return "\n".join(out)
+
+
+def unit(rng, i):
+    name = title(rng, 1) + " " + rng.choice(["Knight", "Mage", "Lord", "Fiend", "Wraith"])
+    lines = [
+        "#textdomain wesnoth-loti",
+        "[unit_type]",
+        "    id={}{}".format(name.replace(" ", ""), i),
+        "    name= _ \"{}\"".format(name),
+        "    race=human",
+        "    hitpoints={}".format(rng.randint(30, 300)),
+        "    description= _ \"{}\" + {{SPECIAL_NOTES}} + {{SPECIAL_NOTES_SOMETHING}}".format(sentence(rng, 30)),
+        noise(rng, 4),
+        advancements(rng, "adv", rng.randint(3, 12)),
+    ]
+    if rng.random() < 0.3:
+        lines.append("    [variation]")
+        lines.append("        variation_id=alt")
+        lines.append(noise(rng, 8))
+        lines.append(advancements(rng, "var", rng.randint(1, 4), 8))
+        lines.append("    [/variation]")
+    lines.append(noise(rng, 4))
+    wrapper = rng.choice([None, "GENERIC_AMLA", "SOUL_EATER_AMLA", "AMLA_GOD"])
+    if wrapper:
+        lines.append("    {{{} {} (".format(wrapper, rng.randint(5, 12)))
+        lines.append(advancements(rng, "amla", rng.randint(1, 4), 8))
+        lines.append("    ) 9}")
+    else:
+        lines.append("[/unit_type]")
+    return "\n".join(lines) + "\n"
+
+
+def amla(rng):
+    parts = ["#textdomain wesnoth-loti"]
+    sections = [
+        "LEGACY_DISCOVERY", "ADDITIONAL_AMLA", "AMLA_ARCHER_ADVANCEMENTS",
+        "AMLA_MAGE_ADVANCEMENTS", "AMLA_FIGHTER_ADVANCEMENTS",
+    ]
+    for section in sections:
+        parts.append("#define " + section)
+        parts.append(advancements(rng, section.lower()[:5], rng.randint(20, 40)))
+        parts.append("#enddef")
+        parts.append("")
+    parts.append("#define GENERIC_AMLA_HEAL")
+    parts.append("    [effect]\n        apply_to=hitpoints\n        heal_full=yes\n    [/effect]")
+    parts.append("#enddef")
+    return "\n".join(parts) + "\n"
+
+
+def abilities(rng):
+    parts = ["#textdomain wesnoth-loti"]
+    for name in ABILITIES:
+        parts.append("#define ABILITY_" + name)
+        parts.append("    [dummy]")
+        parts.append("        id=" + name.lower())
+        parts.append("        name= _ \"{}\"".format(name.lower().replace("_", " ")))
+        parts.append("        description= _ \"{}\"".format(sentence(rng)))
+        parts.append("    [/dummy]")
+        parts.append("#enddef")
+    parts.append("#define ABILITY_HEALS_OTHER AMOUNT")
+    parts.append("    [heals]")
+    parts.append("        id=heals{AMOUNT}")
+    parts.append("        name= _ \"heals +{AMOUNT}\"")
+    parts.append("        description= _ \"Heals for {AMOUNT} hitpoints.\"")
+    parts.append("        value={AMOUNT}")
+    parts.append("    [/heals]")
+    parts.append("    [heals]")
+    parts.append("        id=heals{AMOUNT}_cure")
+    parts.append("        name= _ \"cures\"")
+    parts.append("        description= _ \"Cures.\"")
+    parts.append("    [/heals]")
+    parts.append("#enddef")
+    for name in SPECIALS + ["PLAGUE_TYPE_LOTI"]:
+        parts.append("#define WEAPON_SPECIAL_" + name + (" TYPE" if name.startswith("PLAGUE") else ""))
+        parts.append("    [damage]")
+        parts.append("        id=" + name.lower())
+        parts.append("        name= _ \"{}\"".format(name.lower().replace("_", " ")))
+        parts.append("        description= _ \"{}\"".format(sentence(rng)))
+        parts.append("#ifdef HARD")
+        parts.append("        multiply=2")
+        parts.append("#else")
+        parts.append("        multiply=1.5")
+        parts.append("#endif")
+        parts.append("    [/damage]")
+        parts.append("#enddef")
+    parts.append("#define SPECIAL_NOTES_SOMETHING")
+    parts.append("_\" This unit is something special.\"#enddef")
+    parts.append("#define UNRELATED_HELPER")
+    parts.append("    [dummy]\n        id=helper\n    [/dummy]")
+    parts.append("#enddef")
+    return "\n".join(parts) + "\n"
+
+
+def scenario(rng, chapter, i):
+    lines = [
+        "#textdomain wesnoth-loti",
+        "[scenario]",
+        "    id={:02}_{}".format(i, rng.choice(WORDS)),
+        "    name= _ \"{}\"".format(title(rng, 3)),
+        "    next_scenario=foo",
+        "    {{DROPS {} {} (sword,bow,sword,mace) no 2,3}}".format(rng.randint(5, 30), rng.randint(5, 30)),
+        "#ifdef HARD",
+        "    {DROPS 10 10 (axe,axe,spear) yes 4}",
+        "#else",
+        "    {DROPS 15 10 (axe,spear) yes 4}",
+        "#endif",
+    ]
+    for side in range(rng.randint(2, 5)):
+        lines.append("    [side]")
+        lines.append("        side={}".format(side + 1))
+        lines.append("        {{GOLD {} {} {}}}".format(100, 150, 200))
+        lines.append("        [ai]\n            aggression=0.5\n        [/ai]")
+        lines.append("    [/side]")
+    for _ in range(rng.randint(3, 15)):
+        lines.append("    [event]")
+        lines.append("        name=turn {}".format(rng.randint(1, 20)))
+        lines.append("        [message]")
+        lines.append("            speaker=narrator")
+        lines.append("            message= _ \"{}\"".format(sentence(rng, 25)))
+        lines.append("        [/message]")
+        lines.append("    [/event]")
+    if rng.random() < 0.2:
+        lines.append("    {BEELZEBUB_SPAWN_POINT 3 2 10 12 2}")
+    lines.append("[/scenario]")
+    return "\n".join(lines) + "\n"
+
+
+def make_tree(root, scale=1.0, seed=0):
+    rng = random.Random(seed)
+    root = pathlib.Path(root)
+    (root / "utils").mkdir(parents=True, exist_ok=True)
+    (root / "utils" / "item_list.cfg").write_text(item_list(rng, int(700 * scale)), encoding="utf-8")
+    (root / "utils" / "amla.cfg").write_text(amla(rng), encoding="utf-8")
+    (root / "utils" / "abilities.cfg").write_text(abilities(rng), encoding="utf-8")
+    for race in range(max(1, int(8 * scale))):
+        d = root / "units" / "race{}".format(race)
+        d.mkdir(parents=True, exist_ok=True)
+        for i in range(12):
+            (d / "{}_Unit_{}.cfg".format(race * 12 + i, rng.choice(WORDS))).write_text(
+                unit(rng, i), encoding="utf-8"
+            )
+    for chapter in range(1, 4):
+        d = root / "scenarios{}".format(chapter)
+        d.mkdir(parents=True, exist_ok=True)
+        for i in range(1, max(2, int(10 * scale))):
+            (d / "{:02}_{}.cfg".format(i, rng.choice(WORDS).title())).write_text(
+                scenario(rng, chapter, i), encoding="utf-8"
+            )
+    return root
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic LotI-shaped tree")
+    parser.add_argument("dir")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_tree(args.dir, args.scale, args.seed)
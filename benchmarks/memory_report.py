@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Peak RSS of parsing a whole LotI tree and keeping every tree alive, as a
+# generator run does, or with --full of a whole generator run writing the
+# pages. Each measurement runs in a fresh interpreter, and --against
+# measures another git revision of the package for comparison:
+#
+#   python3 -m benchmarks.memory_report [LotI path] --against HEAD~1 [--full]
+
+import argparse
+import contextlib
+import io
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+
+def lotI_files(start):
+    start = pathlib.Path(start)
+    yield from sorted((start / "units").rglob("*.cfg"))
+    for chapter in sorted(start.glob("scenarios*")):
+        yield from sorted(chapter.glob("*.cfg"))
+    for name in ("item_list.cfg", "amla.cfg", "abilities.cfg"):
+        if (start / "utils" / name).exists():
+            yield start / "utils" / name
+
+
+def measure(start):
+    from loti_wiki_gen import wml_parser
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    trees = []
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fname in lotI_files(start):
+            try:
+                trees.append(wml_parser.parse(fname))
+            except TypeError:
+                # Revisions before parse accepted a path
+                trees.append(wml_parser.parse(fname.read_text(encoding="utf-8"), fname, 1))
+    elapsed = time.perf_counter() - begin
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} {} {} {}".format(len(trees), before, after, elapsed))
+
+
+def measure_full(start):
+    from loti_wiki_gen import __main__
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    begin = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The pages are written to the working directory, and the parse
+        # cache goes under XDG_CACHE_HOME in revisions that have one
+        os.chdir(tmp)
+        os.environ["XDG_CACHE_HOME"] = tmp
+        sys.argv = ["loti_wiki_gen", str(start), "--version", "benchmark"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            __main__.main()
+    elapsed = time.perf_counter() - begin
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} {} {} {}".format(len(list(lotI_files(start))), before, after, elapsed))
+
+
+def run(root, start, full=False):
+    out = subprocess.check_output(
+        [sys.executable, __file__, "--measure-full" if full else "--measure", str(start)],
+        env={"PYTHONPATH": str(root), "PATH": ""},
+    )
+    files, before, after, elapsed = out.split()
+    return int(files), int(before), int(after), float(elapsed)
+
+
+def export(rev, dest):
+    archive = subprocess.check_output(["git", "archive", rev, "loti_wiki_gen"])
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dest)
+    return dest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report peak memory of parsing a LotI tree")
+    parser.add_argument("dir", nargs="?", help="LotI root, a synthetic tree is generated if omitted")
+    parser.add_argument("--against", metavar="REV", help="Also measure this git revision")
+    parser.add_argument("--scale", type=float, default=1.0, help="Size of the synthetic tree")
+    parser.add_argument("--full", action="store_true", help="Measure a whole generator run instead of just parsing")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--measure-full", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+        return
+    if args.measure_full:
+        measure_full(pathlib.Path(args.measure_full).resolve())
+        return
+
+    from . import corpus
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = args.dir or corpus.make_tree(pathlib.Path(tmp) / "loti", args.scale)
+        roots = [("working tree", pathlib.Path(__file__).resolve().parent.parent)]
+        if args.against:
+            roots.insert(0, (args.against, export(args.against, pathlib.Path(tmp) / "against")))
+        for name, root in roots:
+            files, before, after, elapsed = run(root, start, args.full)
+            print(
+                "{}: {} files in {:.2f}s, peak RSS {:.1f} MiB ({:.1f} MiB for the {})".format(
+                    name, files, elapsed, after / 1024, (after - before) / 1024, "run" if args.full else "trees"
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Adversarial WML of growing size, made from the malformed shapes that used
+# to send the regular expressions backtracking. Each case is timed at a few
+# sizes, and the time should only double when the size does. Run from the
+# repository root:
+#
+#   python3 -m benchmarks.stress [--size 16384] [--save DIR]
+
+import argparse
+import contextlib
+import io
+import pathlib
+import time
+
+from loti_wiki_gen import extractor, wml_parser
+
+CASES = [
+    # (name, text of about n bytes, what to run on it)
+    ("unclosed quote", lambda n: '[a]\nk = "' + "x = 1\n" * (n // 6), "parse"),
+    ("spaces before a value", lambda n: "x=" + " " * n + "1\n", "parse"),
+    ("spaces after a value", lambda n: "x = 1" + " " * n, "parse"),
+    ("adjacent macros", lambda n: "{A}" * (n // 3) + "\n", "parse"),
+    ("unclosed <<", lambda n: "k = " + "<<a " * (n // 4) + "\n", "parse"),
+    ("unclosed concatenation", lambda n: 'k = "a" + {B' * (n // 12) + "\n", "parse"),
+    ("AMLA without a closing brace", lambda n: "{GENERIC_AMLA x(" + ")a" * (n // 2), "amla"),
+]
+
+
+def run(kind, text):
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            if kind == "amla":
+                extractor.unwrap_amla(text)
+            else:
+                wml_parser.parse(text, "stress.cfg", 1)
+        except (RuntimeError, ValueError):
+            # Most of these aren't valid WML, they only have to fail quickly
+            pass
+
+
+def timed(kind, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.process_time()
+        run(kind, text)
+        best = min(best, time.process_time() - begin)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the parser on adversarial inputs")
+    parser.add_argument("--size", type=int, default=16384, help="Smallest input size in bytes")
+    parser.add_argument("--steps", type=int, default=3, help="Number of doublings of the size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="DIR", help="Also write the largest input of each case here")
+    args = parser.parse_args()
+
+    wml_parser.TIME_BUDGET = None
+    sizes = [args.size << i for i in range(args.steps + 1)]
+    print("{:30}".format("case") + "".join("{:>12}".format(size) for size in sizes) + "     growth")
+    for name, make, kind in CASES:
+        times = [timed(kind, make(size), args.repeat) for size in sizes]
+        growth = (times[-1] / times[0]) ** (1 / args.steps) if times[0] else float("nan")
+        print(
+            "{:30}".format(name)
+            + "".join("{:10.2f}ms".format(t * 1000) for t in times)
+            + "     x{:.1f}".format(growth)
+        )
+        if args.save:
+            path = pathlib.Path(args.save)
+            path.mkdir(parents=True, exist_ok=True)
+            (path / (name.replace(" ", "_") + ".cfg")).write_text(make(sizes[-1]), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,13 +16,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import io
 import pathlib
+import sys
 import itertools
 import time
 import subprocess
 import configparser
+import sqlite3
 
-from . import wml_parser, extractor, writer, utils, index
+from . import wml_parser, extractor, writer, utils, index, cache, preprocessor, stages, graph
 
 __version__ = "0.3.5.1"
 
@@ -43,7 +46,16 @@ Other LotI-related wiki pages:
 """.lstrip().format(time.ctime(), __version__)
 
 
-def auto_upload(config):
+titles = {
+    "items.wiki": "LotI Items",
+    "abilities.wiki": "LotI Abilities",
+    "standard_advancements.wiki": "LotI Standard Advancements",
+    "unit_advancements.wiki": "LotI Unit Advancements",
+    "scenarios.wiki": "LotI Scenarios",
+}
+
+
+def auto_upload(config, written):
     import requests
     import getpass
     import bs4
@@ -83,13 +95,9 @@ def auto_upload(config):
     print("Logging in successful")
 
     # save action
-    for title, fname in [
-            ("LotI Items", "items.wiki"),
-            ("LotI Abilities", "abilities.wiki"),
-            ("LotI Standard Advancements", "standard_advancements.wiki"),
-            ("LotI Unit Advancements", "unit_advancements.wiki"),
-            ("LotI Scenarios", "scenarios.wiki")
-            ]:
+    for fname, title in titles.items():
+        if fname not in written:
+            continue
         print("Updating", title + "...")
         r = s.get("https://wiki.wesnoth.org/index.php?title=" + title + "&action=edit")
         soup = bs4.BeautifulSoup(r.text, "html.parser")
@@ -107,18 +115,282 @@ def auto_upload(config):
             print("Update of", title, "successful")
 
 
+def sort_by_first(x):
+    if x[0] == "GENERIC_AMLA_ADVANCEMENTS":
+        return "0" + x[0]
+    if x[0] == "ADDITIONAL_AMLA":
+        return "1" + x[0]
+    if x[0][0] == "S":
+        return "2" + x[0]
+    return "3" + x[0]
+
+
+def sort_by_first2(x):
+    return x[0].lower()
+
+
+def sort_by_type(item):
+    type = item[1].keys["sort"].any
+    if type in writer.sort_translations:
+        type = writer.sort_translations[type]
+    return type
+
+
+def sort_ability_type(ability):
+    type = ability[2]
+    if (type == "dummy"):
+        type = "Other"
+    return type
+
+
+def sort_by_chapter(scenario):
+    return scenario[0]
+
+
+def scan_standard_advancements(start):
+    print("Scanning standard advancements...")
+    standard_advancements = list(extractor.extract_standard_advancements(start / "utils" / "amla.cfg"))
+    standard_advancements.sort(key=sort_by_first)
+    print("Found", len(standard_advancements), "standard advancements")
+    return standard_advancements
+
+
+def scan_abilities(start):
+    print("Scanning abilities...")
+    abilities = list(extractor.extract_abilities(start))
+    abilities.sort(key=sort_by_first2)
+    print("Found", len(abilities), "abilities")
+    return abilities, extractor.special_notes_translation
+
+
+def scan_unit_advancements(units, jobs):
+    # Reads the special notes from extractor.special_notes_translation
+    print("Scanning unit advancements...")
+    unit_advancements = list(extractor.extract_unit_advancements(units, jobs))
+    unit_advancements.sort(key=sort_by_first2)
+    print("Found", len(unit_advancements), "unit advancements")
+    return unit_advancements
+
+
+def scan_items(start):
+    print("Scanning items...")
+    items = list(extractor.extract_items(start))
+    items.sort(key=sort_by_type)
+    print("Found", len(items), "items")
+    return items
+
+
+def scan_scenarios(start):
+    print("Scanning scenarios...")
+    scenarios = list(extractor.extract_scenarios(start))
+    scenarios.sort(key=lambda x: x[:2])
+    print("Found", len(scenarios), "scenarios")
+    return [list(chapter) for _, chapter in itertools.groupby(scenarios, sort_by_chapter)]
+
+
+def make_graph(unit_advancements, standard_advancements, verbose):
+    print("Linking advancement requirements...")
+    return graph.Graph(itertools.chain(unit_advancements, standard_advancements), verbose)
+
+
+def collect_macros(start):
+    print("Collecting macros...")
+    return preprocessor.Preprocessor(start)
+
+
+def scan_chapter(start, chapter):
+    print("Scanning chapter {} scenarios...".format(chapter[0]))
+    scenarios = list(extractor.extract_scenarios(start, [chapter]))
+    scenarios.sort(key=lambda x: x[:2])
+    return scenarios
+
+
+def write_block(file, write):
+    # Write one entry through a buffer, and return what was written
+    block = io.StringIO()
+    write(block)
+    file.write(block.getvalue())
+    return block.getvalue()
+
+
+def write_items(items, items_file, links, version, records):
+    print(header.format("all the items", "", version), file=items_file)
+
+    for type, items in itertools.groupby(items, sort_by_type):
+        print("==", type, "==", file=items_file)
+        items = list(items)
+        items.sort(key=sort_by_first2)
+        names = [n for n, *_ in items]
+        for i, item in enumerate(items):
+            duplicated = i != names.index(item[0])
+            block = write_block(items_file, lambda out: writer.write_item(*item, out, links, duplicated_item=duplicated))
+            if not duplicated:
+                records.append(("item", "", item[0], block))
+
+
+def write_abilities(abilities, ability_file, links, version, records):
+    print(header.format("all the abilities and weapon specials", "", version), file=ability_file)
+
+    for section, abilities in itertools.groupby(abilities, sort_by_first2):
+        abilities = list(abilities)
+        abilities.sort(key = sort_ability_type)
+        print("==", abilities[0][0], "==", file=ability_file)
+        for type, abs in itertools.groupby(abilities, sort_ability_type):
+            print("===", utils.english_title(type.replace("_", " ")), "===", file=ability_file)
+            abs = list(abs)
+            abs.sort(key = lambda x: x[1])
+            for ab in abs:
+                writer.write_ability(*ab, ability_file, links)
+
+
+def write_standard_advancements(standard_advancements, adv_standard_file, links, version, records):
+    print(header.format("all the advancements available for categories of units",
+                        "See [[LotI Standard Advancements]] for unit-specific advancements.",
+                        version), file=adv_standard_file)
+
+    for section, advs in itertools.groupby(standard_advancements, sort_by_first):
+        section = section[1:]
+        if section == "GENERIC_AMLA_ADVANCEMENTS":
+            section = "Legacies and Books"
+        elif section == "ADDITIONAL_AMLA":
+            section = "Soul Eater and God Advancements"
+        else:
+            section = utils.english_title(section.replace("_", " ").replace("AMLA ", ""))
+        print("==", utils.english_title(section), "==", file=adv_standard_file)
+        print(file=adv_standard_file)
+        for adv in advs:
+            block = write_block(adv_standard_file, lambda out: writer.write_advancement(*adv, out, links))
+            records.append(("advancement", adv[0], adv[1], block))
+        print(file=adv_standard_file)
+
+
+def write_unit_advancements(unit_advancements, adv_units_file, links, version, records):
+    print(header.format("all the advancements that are unit specific",
+                        "See [[LotI Standard Advancements]] for general advancements such as legacies and books.",
+                        version), file=adv_units_file)
+
+    for section, advs in itertools.groupby(unit_advancements, sort_by_first2):
+        advs = list(advs)
+        if advs[0][0] == "Data Loaders":
+            continue
+        print("==", advs[0][0], "==", file=adv_units_file)
+        print("<span style='color:#808080'><i>{}</i></span>".format(advs[0][-1].replace("\n", "<br/>\n")), file=adv_units_file)
+        print(file=adv_units_file)
+        for adv in advs:
+            block = write_block(adv_units_file, lambda out: writer.write_advancement(*adv[:-1], out, links))
+            records.append(("advancement", adv[0], adv[1], block))
+        print(file=adv_units_file)
+
+
+def write_scenarios(chapters, scenarios_file, links, version, records):
+    # chapters are lists of a chapter's scenarios, which may be made while
+    # this runs
+    print(header.format("all the scenarios",
+                        "",
+                        version), file=scenarios_file)
+
+    for scenarios in chapters:
+        if not scenarios:
+            continue
+        print("== Chapter {} ==".format(scenarios[0][0]), file=scenarios_file)
+        print(file=scenarios_file)
+        for scenario in scenarios:
+            if (scenario[1].startswith("test")):
+                continue
+            writer.write_scenario(*scenario, scenarios_file)
+        print(file=scenarios_file)
+
+
+pages = [
+    # (file, what it lists, writer, the section it lists, the names it links
+    # to). Pages that name abilities and weapon specials need the
+    # preprocessor for the macros the writer has no name for.
+    ("items.wiki", "item", write_items, "items", ("item names", "ability names", "preprocessor")),
+    ("abilities.wiki", "ability", write_abilities, "abilities", ("ability names",)),
+    ("standard_advancements.wiki", "standard advancement", write_standard_advancements, "standard advancements",
+     ("advancement names", "ability names", "advancement graph", "preprocessor")),
+    ("unit_advancements.wiki", "unit advancement", write_unit_advancements, "unit advancements",
+     ("advancement names", "ability names", "advancement graph", "preprocessor")),
+    ("scenarios.wiki", "scenario", write_scenarios, "scenarios", ()),
+]
+
+
+def write_page(fname, what, write, entries, linked, version, verbose):
+    # Write a page, and return the (kind, section, name, anchor, block) of
+    # each entry on it for the saved index
+    print("Writing", what, "information to", fname)
+    idx = index.Index(linked.get("advancement names", ()), linked.get("ability names", ()), linked.get("item names", ()), verbose)
+    # The links are placeholders until the whole page has been written
+    links = index.Links(idx, fname, linked.get("advancement graph"), linked.get("preprocessor"))
+    page = io.StringIO()
+    blocks = []
+    write(entries, page, links, version, blocks)
+    links.resolve()
+    with open(fname, "w", encoding="utf-8") as file:
+        file.write(links.sub(page.getvalue()))
+    return [(kind, section, name, idx.anchor(kind, section, name), links.sub(block)) for kind, section, name, block in blocks]
+
+
+def page_stage(page, start, version, pipeline, verbose):
+    # The stage writing a page, which produces its index entries under its
+    # file name
+    fname, what, write, section, linked = page
+    if pipeline and section == "scenarios":
+        # Scenarios don't link to anything, so they are scanned a chapter at
+        # a time while their page is written instead
+        return stages.Stage(fname, (), (fname,), lambda: write_page(
+            fname, what, write, (scan_chapter(start, chapter) for chapter in extractor.scenario_chapters(start)), {}, version, verbose))
+    return stages.Stage(fname, (section,) + linked, (fname,), lambda entries, *values: write_page(
+        fname, what, write, entries, dict(zip(linked, values)), version, verbose))
+
+
+def query(argv, config):
+    parser = argparse.ArgumentParser(prog="loti_wiki_gen query", description="Look up the wiki link of an item or advancement in the index saved by the last run")
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--index-file", default=config.get("index_file", None) or "loti_index.sqlite", help="The index to look in")
+    options.add_argument("--block", action="store_true", help="Print the wiki text of the entry instead of its link")
+    kinds = parser.add_subparsers(dest="kind", required=True)
+    kinds.add_parser("item", parents=[options]).add_argument("name")
+    advancement = kinds.add_parser("advancement", parents=[options])
+    advancement.add_argument("section", help="Unit name, or the macro of a standard section like GENERIC_AMLA_ADVANCEMENTS")
+    advancement.add_argument("name")
+    advancement.add_argument("--requires", action="store_true", help="Print the advancements that have to be taken before this one, in an order they can be taken in")
+    args = parser.parse_args(argv)
+
+    try:
+        entry = index.lookup(args.index_file, args.kind, getattr(args, "section", ""), args.name)
+    except sqlite3.Error as e:
+        raise SystemExit("Cannot read index {}: {}".format(args.index_file, e))
+    if entry is None:
+        raise SystemExit("No {} {} in {}".format(args.kind, args.name, args.index_file))
+    page, anchor, block, version = entry
+    if getattr(args, "requires", False):
+        try:
+            chain = index.requirements(args.index_file, args.section, args.name)
+        except sqlite3.Error as e:
+            raise SystemExit("Cannot read index {}: {}".format(args.index_file, e))
+        if chain is None:
+            raise SystemExit("{} can never be taken, the advancements it requires require each other".format(args.name))
+        for name in chain:
+            print(name)
+    elif args.block:
+        print(block, end="")
+    else:
+        print("https://wiki.wesnoth.org/{}#{}".format(page.replace(" ", "_"), anchor.replace(" ", "_")))
+
+
 def main():
     global ability_name, special_name
 
     all_config = configparser.ConfigParser()
     all_config.read(["config.ini", "setup.cfg"])
+    config = all_config["lotigen"] if "lotigen" in all_config else {}
 
-    if "lotigen" in all_config:
-        print("Configuration found")
-        config = all_config["lotigen"]
-    else:
-        print("Configuration not found")
-        config = {}
+    if sys.argv[1:2] == ["query"]:
+        query(sys.argv[2:], config)
+        return
+
+    print("Configuration found" if "lotigen" in all_config else "Configuration not found")
 
     parser = argparse.ArgumentParser(prog="loti_wiki_gen", description="Generate the wiki for LotI")
     if config.get("dir", None):
@@ -130,10 +402,23 @@ def main():
     parser.add_argument("--autoupload", action="store_true", help="Upload to the wiki after generation has finished")
     parser.add_argument("--noupdate", action="store_true", help="Do not update <dir> when it is a git repository")
     parser.add_argument("--bug-detect", action="store_true", help="Print information that may be the result of LotI bugs")
+    parser.add_argument("--jobs", type=int, default=1, help="Scan the parts of LotI that don't depend on each other at the same time, and parse unit files, and the big utils files in chunks, with this many workers, 0 for one per CPU")
+    parser.add_argument("--time-budget", type=float, default=float(config.get("time_budget", 60)), help="Seconds a file may take to parse before giving up on it, 0 for no limit")
+    parser.add_argument("--pipeline", action="store_true", default=config.get("pipeline", "no") == "yes", help="Write each page as soon as it can be and drop what it was made from, to use less memory")
+    parser.add_argument("--only", nargs="+", metavar="PAGE", choices=[fname for fname, *_ in pages], help="Only scan for and write these pages")
+    parser.add_argument("--index-file", default=config.get("index_file", None) or "loti_index.sqlite", help="Where to save the links and wiki text of the items and advancements for query, empty for nowhere")
+    parser.add_argument("--no-cache", action="store_true", help="Parse every file instead of using the parse cache")
+    parser.add_argument("--cache-dir", default=config.get("cache_dir", None) or cache.default_dir(), help="Where to keep the parse cache")
+    parser.add_argument("--cache-size", type=int, default=int(config.get("cache_size", 256)), help="Size limit of the parse cache in MiB")
 
     args = parser.parse_args()
 
     wml_parser.BUG_DETECT = extractor.BUG_DETECT = writer.BUG_DETECT = args.bug_detect
+    wml_parser.JOBS = args.jobs
+    wml_parser.TIME_BUDGET = args.time_budget or None
+    if not args.no_cache:
+        wml_parser.CACHE = cache.ParseCache(pathlib.Path(args.cache_dir).expanduser(), args.cache_size * 1024 * 1024,
+                                            cache.source_version(wml_parser))
 
     start = pathlib.Path(args.dir).expanduser().resolve()
     print("LotI Scraper version", __version__, "loading from directory", start)
@@ -141,7 +426,7 @@ def main():
     if args.version is None:
         print("Scanning info...")
         if (start / "_info.cfg").exists():
-            info = wml_parser.parse((start / "_info.cfg").open().read())
+            info = wml_parser.parse(start / "_info.cfg")
             version = info.tags["info"][0].keys["version"].any
         else:
             if not args.noupdate:
@@ -157,140 +442,46 @@ def main():
 
     print("LotI version is", version)
 
-    def sort_by_first(x):
-        if x[0] == "GENERIC_AMLA_ADVANCEMENTS":
-            return "0" + x[0]
-        if x[0] == "ADDITIONAL_AMLA":
-            return "1" + x[0]
-        if x[0][0] == "S":
-            return "2" + x[0]
-        return "3" + x[0]
-
-    def sort_by_first2(x):
-        return x[0].lower()
-
-    def sort_by_type(item):
-        type = item[1].keys["sort"].any
-        if type in writer.sort_translations:
-            type = writer.sort_translations[type]
-        return type
-
-    def sort_ability_type(ability):
-        type = ability[2]
-        if (type == "dummy"):
-            type = "Other"
-        return type
-
-    print("Scanning standard advancements...")
-    standard_advancements = list(extractor.extract_standard_advancements(start / "utils" / "amla.cfg"))
-    standard_advancements.sort(key=sort_by_first)
-
-    #extract abilities before unit advancements because some special notes are defined in the ability file
-    print("Scanning abilities...")
-    abilities = list(extractor.extract_abilities(start))
-    abilities.sort(key=sort_by_first2)
-
-    print("Scanning unit advancements...")
-    unit_advancements = list(extractor.extract_unit_advancements(start / "units"))
-    unit_advancements.sort(key=sort_by_first2)
-
-    print("Scanning items...")
-    items = list(extractor.extract_items(start))
-    items.sort(key=sort_by_type)
-
-    print("Scanning scenarios...")
-    scenarios = list(extractor.extract_scenarios(start))
-    scenarios.sort(key=lambda x: x[:2])
-
-    print("Found", len(abilities), "abilities,", len(standard_advancements), "standard advancements,",
-          len(unit_advancements), "unit advancements,", len(items), "items and", len(scenarios), "scenarios")
-
-    print("Creating index...")
-    idx = index.Index(unit_advancements, standard_advancements, abilities, items, verbose=args.bug_detect)
-
-    print("Writing item information to items.wiki")
-    with open("items.wiki", "w", encoding="utf-8") as items_file:
-        print(header.format("all the items", "", version), file=items_file)
-
-        for type, items in itertools.groupby(items, sort_by_type):
-            print("==", type, "==", file=items_file)
-            items = list(items)
-            items.sort(key=sort_by_first2)
-            names = [n for n, *_ in items]
-            for i, item in enumerate(items):
-                writer.write_item(*item, items_file, idx, duplicated_item=i != names.index(item[0]))
-
-
-    print("Writing ability information to abilities.wiki")
-    with open("abilities.wiki", "w", encoding="utf-8") as ability_file:
-        print(header.format("all the abilities and weapon specials", "", version), file=ability_file)
-
-        for section, abilities in itertools.groupby(abilities, sort_by_first2):
-            abilities = list(abilities)
-            abilities.sort(key = sort_ability_type)
-            print("==", abilities[0][0], "==", file=ability_file)
-            for type, abs in itertools.groupby(abilities, sort_ability_type):
-                print("===", utils.english_title(type.replace("_", " ")), "===", file=ability_file)
-                abs = list(abs)
-                abs.sort(key = lambda x: x[1])
-                for ab in abs:
-                    writer.write_ability(*ab, ability_file, idx)
-
-    print("Writing standard advancement information to standard_advancements.wiki")
-    with open("standard_advancements.wiki", "w", encoding="utf-8") as adv_standard_file:
-        print(header.format("all the advancements available for categories of units",
-                            "See [[LotI Standard Advancements]] for unit-specific advancements.",
-                            version), file=adv_standard_file)
-
-        for section, advs in itertools.groupby(standard_advancements, sort_by_first):
-            section = section[1:]
-            if section == "GENERIC_AMLA_ADVANCEMENTS":
-                section = "Legacies and Books"
-            elif section == "ADDITIONAL_AMLA":
-                section = "Soul Eater and God Advancements"
-            else:
-                section = utils.english_title(section.replace("_", " ").replace("AMLA ", ""))
-            print("==", utils.english_title(section), "==", file=adv_standard_file)
-            print(file=adv_standard_file)
-            for adv in advs:
-                writer.write_advancement(*adv, adv_standard_file, idx)
-            print(file=adv_standard_file)
-
-    print("Writing unit advancement information to unit_advancements.wiki")
-    with open("unit_advancements.wiki", "w", encoding="utf-8") as adv_units_file:
-        print(header.format("all the advancements that are unit specific",
-                            "See [[LotI Standard Advancements]] for general advancements such as legacies and books.",
-                            version), file=adv_units_file)
-
-        for section, advs in itertools.groupby(unit_advancements, sort_by_first2):
-            advs = list(advs)
-            if advs[0][0] == "Data Loaders":
-                continue
-            print("==", advs[0][0], "==", file=adv_units_file)
-            print("<span style='color:#808080'><i>{}</i></span>".format(advs[0][-1].replace("\n", "<br/>\n")), file=adv_units_file)
-            print(file=adv_units_file)
-            for adv in advs:
-                writer.write_advancement(*adv[:-1], adv_units_file, idx)
-            print(file=adv_units_file)
-
-    print("Writing scenario information to scenarios.wiki")
-    with open("scenarios.wiki", "w", encoding="utf-8") as scenarios_file:
-        print(header.format("all the scenarios",
-                            "",
-                            version), file=scenarios_file)
-
-        for _, scenarios in itertools.groupby(scenarios, lambda x: x[0]):
-            scenarios = list(scenarios)
-            print("== Chapter {} ==".format(scenarios[0][0]), file=scenarios_file)
-            print(file=scenarios_file)
-            for scenario in scenarios:
-                if (scenario[1].startswith("test")):
-                    continue
-                writer.write_scenario(*scenario, scenarios_file)
-            print(file=scenarios_file)
+    wanted = [page for page in pages if args.only is None or page[0] in args.only]
+    writing = [page_stage(page, start, version, args.pipeline, args.bug_detect) for page in wanted]
+
+    # Each page is written, and the tags it was made from dropped, as soon
+    # as it can be, so pages come first and the scans are in the order that
+    # lets the most pages be written before the next one. Unit advancements
+    # are the biggest and go after the abilities and items, whose pages are
+    # then already written; they also need the special notes defined in
+    # the ability file.
+    scan = [stage for stage in writing if stage.reads] + [
+        stages.Stage("item names", ("items",), ("item names",), index.item_names),
+        stages.Stage("ability names", ("abilities",), ("ability names",), index.ability_names),
+        stages.Stage("advancement names", ("unit advancements", "standard advancements"), ("advancement names",), index.advancement_names),
+        stages.Stage("advancement graph", ("unit advancements", "standard advancements"), ("advancement graph",),
+                     lambda units, standard: make_graph(units, standard, args.bug_detect)),
+        stages.Stage("preprocessor", (), ("preprocessor",), lambda: collect_macros(start)),
+        stages.Stage("abilities", (), ("abilities", "special notes"), lambda: scan_abilities(start)),
+        stages.Stage("items", (), ("items",), lambda: scan_items(start)),
+        stages.Stage("standard advancements", (), ("standard advancements",), lambda: scan_standard_advancements(start)),
+        stages.Stage("unit advancements", ("special notes",), ("unit advancements",), lambda notes: scan_unit_advancements(start / "units", args.jobs)),
+        stages.Stage("scenarios", (), ("scenarios",), lambda: scan_scenarios(start)),
+    ] + [stage for stage in writing if not stage.reads]
+    scan = stages.needed(scan, [stage.name for stage in writing])
+    written, times = stages.run_stages(scan, args.jobs, keep={stage.name for stage in writing} | {"advancement graph", "preprocessor"})
+    print(stages.summary(scan, times))
+
+    if wml_parser.CACHE is not None:
+        wml_parser.CACHE.evict()
+
+    if args.index_file:
+        print("Saving the index to", args.index_file)
+        index.save(args.index_file, version, {titles[fname]: written[fname] for fname, *_ in wanted}, written.get("advancement graph"))
 
     if args.autoupload:
-        auto_upload(config)
+        auto_upload(config, [fname for fname, *_ in wanted])
+
+    if wml_parser.CACHE is not None:
+        print(wml_parser.CACHE.summary())
+    if "preprocessor" in written:
+        print(written["preprocessor"].summary())
 
     print("All done!")
 
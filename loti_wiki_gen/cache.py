@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+import threading
+import time
+
+
+def default_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path("~/.cache").expanduser()
+    return pathlib.Path(base) / "loti_wiki_gen"
+
+
+def source_version(*modules):
+    # Any edit to the parser invalidates everything it produced
+    h = hashlib.sha256()
+    for module in modules:
+        h.update(pathlib.Path(module.__file__).read_bytes())
+    return h.hexdigest()
+
+
+class ParseCache:
+    # Parsed trees pickled one file per entry, named by the hash of the
+    # input. Entries are written to a temporary file and renamed into place,
+    # so concurrent runs only ever see whole entries, and reads bump the
+    # mtime so eviction can drop the least recently used ones.
+    def __init__(self, directory, max_size, version):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.version = version
+        self.hits = self.misses = 0
+        # Stages running in other threads count at the same time
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes are sent the cache, and each gets its own lock
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def key(self, data, *options):
+        h = hashlib.sha256()
+        for part in (self.version,) + options:
+            h.update(str(part).encode("utf-8"))
+            h.update(b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    def load(self, key):
+        path = self.directory / (key + ".pickle")
+        try:
+            with path.open("rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def get(self, key):
+        tree = self.load(key)
+        if tree is None:
+            self.count(0, 1)
+        else:
+            self.count(1, 0)
+        return tree
+
+    def count(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def put(self, key, tree):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(self.directory), suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, str(self.directory / (key + ".pickle")))
+        except (OSError, pickle.PicklingError, RecursionError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for path in self.directory.glob("*"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if path.suffix == ".pickle":
+                entries.append((st.st_mtime, st.st_size, path))
+            elif path.suffix == ".tmp" and now - st.st_mtime > 3600:
+                # Left behind by a run that was killed mid-write
+                path.unlink(missing_ok=True)
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                continue
+            total -= size
+
+    def summary(self):
+        return "Parse cache: {} hits, {} misses".format(self.hits, self.misses)
@@ -15,7 +15,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
+import collections
+import concurrent.futures
 import string
 
 from . import utils, wml_parser
@@ -70,7 +71,7 @@ def special_notes_sub(str):
 def extract_abilities(start):
     global special_notes_translation
     fname = start / "utils" / "abilities.cfg"
-    stuff = wml_parser.parse(fname.open(encoding="utf-8").read(), fname, 1)
+    stuff = wml_parser.parse(fname)
     for name, (macro,) in stuff.tags.items():
         if name.startswith("ABILITY"):
             section = "Abilities"
@@ -91,9 +92,12 @@ def extract_abilities(start):
                 ), tag_type, name, tag
             elif len(tags) == 2:
                 a, b = tags
-                a.keys["name"].all = a.keys["name"].any + " and " + b.keys["name"].any
-                a.keys["description"].all = (
-                    a.keys["description"].any + " " + b.keys["description"].any
+                a = wml_parser.with_keys(
+                    a,
+                    name=a.keys["name"].any + " and " + b.keys["name"].any,
+                    description=(
+                        a.keys["description"].any + " " + b.keys["description"].any
+                    ),
                 )
                 yield section, a.keys["name"].any.replace("{", "").replace(
                     "}", ""
@@ -104,65 +108,192 @@ def extract_abilities(start):
 
 def extract_items(start):
     fname = start / "utils" / "item_list.cfg"
-    data = wml_parser.parse(fname.open(encoding="utf-8").read(), fname, 1)
-    for tag in data.tags["ITEM_LIST"][0].tags["object"]:
-        if "name" in tag.keys and "filter" not in tag.tags:
-            yield tag.keys["name"].any, tag
+    # Each [object] is handed over as soon as it is closed. Only the first
+    # ITEM_LIST at the top level counts.
+    depth = 0
+    for event, name, *rest in wml_parser.iterparse(fname, build=["ITEM_LIST/object"]):
+        if event == "start_tag" or event == "define":
+            depth += 1
+        elif event == "end_tag":
+            depth -= 1
+            if depth == 0 and name == "ITEM_LIST":
+                break
+            tag = rest[0]
+            if tag is not None and "name" in tag.keys and "filter" not in tag.tags:
+                yield tag.keys["name"].any, tag
 
 
-def extract_unit_advancements(start):
+def unit_files(start):
     for item in start.iterdir():
         if item.is_dir():
-            yield from extract_unit_advancements(item)
+            yield from unit_files(item)
         elif item.suffix == ".cfg":
-            data = item.open(encoding="utf-8").read()
-            if "GENERIC_AMLA" in data:
-                amla_mode = "\nThis unit also has generic AMLA advancements"
-            elif "SOUL_EATER_AMLA" in data:
-                amla_mode = "\nThis unit also has soul eater AMLA advancements"
-            elif "AMLA_GOD" in data:
-                amla_mode = "\nThis unit also has god AMLA advancements"
-            else:
-                amla_mode = ""
-            data = re.sub(
-                "{(?:GENERIC_AMLA|SOUL_EATER_AMLA|AMLA_GOD) [^(]+\((.*)\)[^}]+}",
-                "\\1[/unit_type]",
-                data,
-                0,
-                re.DOTALL,
-            )
-            stuff = wml_parser.parse(data, item, 1)
-            fmt_fname = utils.english_title(
-                item.stem.replace("_", " ").lstrip(" " + string.digits)
+            yield item
+
+
+amla_macros = [
+    # (mode, where the name starts before its "AMLA", name), in the order a
+    # unit file using several of them is described by
+    ("generic", 8, "GENERIC_AMLA"),
+    ("soul eater", 11, "SOUL_EATER_AMLA"),
+    ("god", 0, "AMLA_GOD"),
+]
+
+
+def find_amla(data):
+    # The AMLA mode of a unit file and the (start, end) of each "{MACRO "
+    # wrapper call in it. Every name contains "AMLA", so one walk over those
+    # finds all of them, instead of searching the file once per name.
+    modes = set()
+    calls = []
+    i = data.find("AMLA")
+    while i != -1:
+        for mode, offset, name in amla_macros:
+            start = i - offset
+            if start >= 0 and data.startswith(name, start):
+                modes.add(mode)
+                end = start + len(name)
+                if start and data[start - 1] == "{" and data[end : end + 1] == " ":
+                    calls.append((start - 1, end + 1))
+        i = data.find("AMLA", i + 1)
+    mode = next((mode for mode, _, _ in amla_macros if mode in modes), None)
+    return mode, sorted(calls)
+
+
+def unwrap_amla(data, calls=None):
+    # Replace an AMLA wrapper by its arguments and close the [unit_type] it
+    # ends, like
+    #
+    #   re.sub("{(?:GENERIC_AMLA|...) [^(]+\((.*)\)[^}]+}", "\\1[/unit_type]", data, 0, re.DOTALL)
+    #
+    # but in linear time. The greedy .* ends at the last ")" that is followed
+    # by something other than "}" and then a "}", which is looked for
+    # backwards once instead of backtracking over the rest of the file. No
+    # later wrapper can match after that.
+    if calls is None:
+        calls = find_amla(data)[1]
+    close = data.rfind("}")
+    for call, body in calls:
+        start = data.find("(", body)
+        if start == body:
+            continue
+        if start == -1 or close < start:
+            return data
+        end = data.rfind(")", start + 1, close)
+        while end != -1 and data[end + 1] == "}":
+            end = data.rfind(")", start + 1, end)
+        if end == -1:
+            return data
+        after = data.find("}", end + 1) + 1
+        return data[:call] + data[start + 1 : end] + "[/unit_type]" + data[after:]
+    return data
+
+
+def extract_unit_file(item):
+    advancements = []
+    data = item.read_text(encoding="utf-8")
+    mode, calls = find_amla(data)
+    amla_mode = "\nThis unit also has {} AMLA advancements".format(mode) if mode else ""
+    data = unwrap_amla(data, calls)
+    stuff = wml_parser.parse(
+        data,
+        item,
+        1,
+        select=[
+            "unit_type/advancement/**",
+            "unit_type/variation/advancement/**",
+        ],
+    )
+    fmt_fname = utils.english_title(
+        item.stem.replace("_", " ").lstrip(" " + string.digits)
+    )
+    for unit in stuff.tags["unit_type"]:
+        if not unit.keys["name"].any:
+            name = fmt_fname
+        elif fmt_fname not in unit.keys["name"].any:
+            name = "{} ({})".format(unit.keys["name"].any, fmt_fname)
+        else:
+            name = unit.keys["name"].any
+        name = utils.english_title(name.replace("female^", ""))
+        desc = special_notes_sub(unit.keys["description"].any) + amla_mode
+        for adv in unit.tags["advancement"]:
+            if "id" not in adv.keys:
+                print(adv.keys.keys())
+            adv = wml_parser.with_keys(
+                adv, description=utils.english_title(adv.keys["description"].any)
             )
-            for unit in stuff.tags["unit_type"]:
-                if not unit.keys["name"].any:
-                    name = fmt_fname
-                elif fmt_fname not in unit.keys["name"].any:
-                    name = "{} ({})".format(unit.keys["name"].any, fmt_fname)
-                else:
-                    name = unit.keys["name"].any
-                name = utils.english_title(name.replace("female^", ""))
-                desc = special_notes_sub(unit.keys["description"].any) + amla_mode
-                for adv in unit.tags["advancement"]:
-                    if "id" not in adv.keys:
-                        print(adv.keys.keys())
-                    adv.keys["description"].all = utils.english_title(
-                        adv.keys["description"].any
-                    )
-                    yield name, adv.keys["id"].any, adv, desc
-                for var in unit.tags["variation"]:
-                    for adv in var.tags["advancement"]:
-                        if "id" not in adv.keys:
-                            print(adv.keys.keys())
-                        adv.keys["description"].all = utils.english_title(
-                            adv.keys["description"].any
-                        )
-                        yield name, adv.keys["id"].any, adv, desc
+            advancements.append((name, adv.keys["id"].any, adv, desc))
+        for var in unit.tags["variation"]:
+            for adv in var.tags["advancement"]:
+                if "id" not in adv.keys:
+                    print(adv.keys.keys())
+                adv = wml_parser.with_keys(
+                    adv, description=utils.english_title(adv.keys["description"].any)
+                )
+                advancements.append((name, adv.keys["id"].any, adv, desc))
+    return advancements
+
+
+def init_unit_worker(notes, bug_detect, cache, symbols, time_budget):
+    # Worker processes don't see what the parent read from abilities.cfg
+    # or the command line, so they are handed it here. Symbols a worker
+    # registers itself may get bits another worker gave other symbols, so
+    # the parent moves them to its own.
+    global special_notes_translation, BUG_DETECT
+    special_notes_translation = notes
+    wml_parser.register_symbols(symbols)
+    wml_parser.TIME_BUDGET = time_budget
+    BUG_DETECT = wml_parser.BUG_DETECT = bug_detect
+    wml_parser.CACHE = cache
+    wml_parser.JOBS = 1
+
+
+def extract_unit_file_in_worker(item):
+    # Only the advancements go back to the parent, with the symbols their
+    # annotations may use and what the file did to the parse cache
+    cache = wml_parser.CACHE
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    advancements = extract_unit_file(item)
+    if cache:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return advancements, wml_parser.symbol_items(), hits, misses
+
+
+def extract_unit_advancements(start, jobs=1):
+    files = list(unit_files(start))
+    if jobs == 1:
+        for item in files:
+            yield from extract_unit_file(item)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs or None,
+        initializer=init_unit_worker,
+        initargs=(
+            special_notes_translation,
+            BUG_DETECT,
+            wml_parser.CACHE,
+            [name for name, _ in wml_parser.symbol_items()],
+            wml_parser.TIME_BUDGET,
+        ),
+    ) as pool:
+        # map keeps the results in file order, so the output is the same as
+        # a serial run
+        for advancements, symbols, hits, misses in pool.map(
+            extract_unit_file_in_worker, files, chunksize=4
+        ):
+            moves = wml_parser.symbol_moves(symbols)
+            if moves:
+                advancements = [
+                    (name, id, wml_parser.move_symbols(adv, moves), desc)
+                    for name, id, adv, desc in advancements
+                ]
+            if wml_parser.CACHE:
+                wml_parser.CACHE.count(hits, misses)
+            yield from advancements
 
 
 def extract_standard_advancements(fname):
-    x = wml_parser.parse(fname.open(encoding="utf-8").read(), fname, 1)
+    x = wml_parser.parse(fname)
     for name, tags in x.tags.items():
         if name.endswith("ADVANCEMENTS") or name in [
             "ADDITIONAL_AMLA",
@@ -171,23 +302,34 @@ def extract_standard_advancements(fname):
             if name == "LEGACY_DISCOVERY":
                 name = "GENERIC_AMLA_ADVANCEMENTS"
             for adv in tags[0].tags["advancement"]:
-                adv.keys["description"].all = utils.english_title(
-                    adv.keys["description"].any
+                adv = wml_parser.with_keys(
+                    adv, description=utils.english_title(adv.keys["description"].any)
                 )
                 yield name, utils.english_title(
                     adv.keys["id"].any.removesuffix("_dummy")
                 ), adv
 
 
-def extract_scenarios(start):
+def scenario_chapters(start):
+    # (number, directories) of each chapter in order
+    chapters = collections.defaultdict(list)
     for chapter in start.glob("scenarios*"):
-        for fname in chapter.glob("*.cfg"):
-            x = wml_parser.parse(fname.open(encoding="utf-8").read(), fname, 1)
-            for scenario in x.tags["scenario"]:
-                yield (
-                    int(chapter.name.replace("scenarios", "")),
-                    "{} &ndash; {}".format(
-                        fname.name.split("_")[0], scenario.keys["name"].any
-                    ),
-                    scenario,
-                )
+        chapters[int(chapter.name.replace("scenarios", ""))].append(chapter)
+    return sorted(chapters.items())
+
+
+def extract_scenarios(start, chapters=None):
+    if chapters is None:
+        chapters = scenario_chapters(start)
+    for number, dirs in chapters:
+        for chapter in dirs:
+            for fname in chapter.glob("*.cfg"):
+                x = wml_parser.parse(fname, select=["scenario"])
+                for scenario in x.tags["scenario"]:
+                    yield (
+                        number,
+                        "{} &ndash; {}".format(
+                            fname.name.split("_")[0], scenario.keys["name"].any
+                        ),
+                        scenario,
+                    )
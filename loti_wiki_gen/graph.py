@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+
+
+def required_names(tag):
+    # The names in an advancement's require_amla, as written
+    if "require_amla" not in tag.keys or tag.keys["require_amla"].any in ("{LEGACY}", ""):
+        return []
+    return [n.strip() for n in tag.keys["require_amla"].any.split(",")]
+
+
+class Graph:
+    # The require_amla graph of the unit and standard advancements, worked
+    # out once for all the pages and queries that need it. Names are only
+    # unique within a section, so the nodes are (section, lower case name)
+    # pairs. Only names are kept, not the tags.
+    def __init__(self, advancements, verbose=False):
+        self.names = {}
+        self.direct = {}
+        # What each copy of an advancement requires, as written, by (section,
+        # lower case name, how many copies came before it)
+        self.copies = {}
+        count = collections.Counter()
+        for section, name, tag, *_ in advancements:
+            node = section, name.lower()
+            required = self.copies[node + (count[node],)] = required_names(tag)
+            count[node] += 1
+            if node in self.direct:
+                # An advancement that is there twice requires what either
+                # copy does
+                self.direct[node].extend(n for n in required if n not in self.direct[node])
+            else:
+                self.names[node] = name
+                self.direct[node] = list(required)
+
+        # Names that aren't in the section are left out of the edges
+        self.edges = {
+            node: list(dict.fromkeys(req for req in ((node[0], n.lower()) for n in names) if req in self.direct))
+            for node, names in self.direct.items()
+        }
+        # Names that aren't in the section. Pages write them without a link,
+        # so they are reported here rather than with the missing links.
+        self.dangling = [
+            (self.names[node], node[0], n) for node, names in self.direct.items() for n in names if not self.has(node[0], n)
+        ]
+        if verbose:
+            for name, section, missing in self.dangling:
+                print("BUG DETECT: The require_amla of the advancement", name, "in", section, "names", missing + ", which isn't there")
+
+        # Kahn's algorithm, taking the advancements in the order they were
+        # found whenever there's a choice
+        needs = {node: len(reqs) for node, reqs in self.edges.items()}
+        dependents = collections.defaultdict(list)
+        for node, reqs in self.edges.items():
+            for req in reqs:
+                dependents[req].append(node)
+        ready = collections.deque(node for node, n in needs.items() if not n)
+        self.order = []
+        while ready:
+            node = ready.popleft()
+            self.order.append(node)
+            for dependent in dependents[node]:
+                needs[dependent] -= 1
+                if not needs[dependent]:
+                    ready.append(dependent)
+
+        # Those left over are on a cycle or require one. Dropping those no
+        # other leftover requires until there are none leaves the cycles.
+        stuck = set(self.edges) - set(self.order)
+        while True:
+            required = {req for node in stuck for req in self.edges[node]}
+            if stuck <= required:
+                break
+            stuck &= required
+        self.cycles = collections.defaultdict(list)
+        for node in self.edges:
+            if node in stuck:
+                self.cycles[node[0]].append(self.names[node])
+        if verbose:
+            for section, names in self.cycles.items():
+                print("BUG DETECT: The require_amla of the advancements", ", ".join(names), "in", section, "go round in circles")
+
+        # Everything that has to be taken before each advancement, in an
+        # order it can be taken in
+        position = {node: i for i, node in enumerate(self.order)}
+        before = {}
+        for node in self.order:
+            before[node] = set(self.edges[node]).union(*(before[req] for req in self.edges[node]))
+        self.prerequisites = {node: sorted(reqs, key=position.__getitem__) for node, reqs in before.items()}
+
+    def has(self, section, name):
+        return (section, name.lower()) in self.direct
+
+    def requires(self, section, name, copy=0):
+        # The names a copy of an advancement requires directly, as written
+        return self.copies.get((section, name.lower(), copy), [])
+
+    def chain(self, section, name):
+        # The names of all the advancements that have to be taken first, in
+        # an order they can be taken in, or None if there is no such order
+        prerequisites = self.prerequisites.get((section, name.lower()))
+        if prerequisites is None:
+            return None
+        return [self.names[node] for node in prerequisites]
+
+    def rows(self):
+        # (section, name, step, required) for each advancement's chain, with
+        # a step and required of None for those that can't be taken
+        for node, name in self.names.items():
+            chain = self.chain(node[0], name)
+            if chain is None:
+                yield node[0], name, None, None
+            for step, required in enumerate(chain or ()):
+                yield node[0], name, step, required
@@ -15,60 +15,242 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import contextlib
+import functools
+import itertools
+import pathlib
+import re
+import sqlite3
+import zlib
+
 from . import writer
 
 
+def item_names(items):
+    return [(name, tag.keys["sort"].any) for name, tag in items]
+
+
+def ability_names(abilities):
+    return [(macro_name, name, type) for section, name, type, macro_name, tag in abilities]
+
+
+def advancement_names(unit_advancements, standard_advancements):
+    # Anchors are numbered over the unit advancements and then the standard
+    # ones, so both are needed to link to either
+    return [
+        (section, name, tag.keys["description"].any)
+        for section, name, tag, *_ in itertools.chain(unit_advancements, standard_advancements)
+    ]
+
+
 class Index:
-    def __init__(self, unit_advancements, standard_advancements, abilities, items, verbose=False):
+    # Made from the names above rather than the tags, so the tags can be
+    # released once their names have been taken. Each kind of anchor is
+    # only worked out the first time one is asked for, so a page does no
+    # more than it needs.
+    def __init__(self, advancements=(), abilities=(), items=(), verbose=False):
         self.verbose = verbose
-        self.item_index = {}
-        self.ability_index = {}
-        self.advancement_index = {}
-        self.advancement_urls = set()
+        self.items = items
+        self.abilities = abilities
+        self.advancements = advancements
 
-        for name, tag in items:
-            self.item_index[name.lower()] = "{}_.E2.80.93_{}".format(name, writer.sort_translations.get(tag.keys["sort"].any, tag.keys["sort"].any))
-
-        for section, name, type, macro_name, tag in abilities:
-            self.ability_index[macro_name] = "{}_.E2.80.93_{}".format(name, type)
-
-        self.process_advancement(unit_advancements)
-        self.process_advancement(standard_advancements)
-
-    def process_advancement(self, advancements):
-        for section, name, tag, *_ in advancements:
-            iname = name
-            ref = "{}_.E2.80.93_{}".format(tag.keys["description"].any.replace(" ", "_"),
-                                           iname.replace(" ", "_"))
-            i = 2
-            while ref in self.advancement_urls:
-                iname = "{}_{}".format(name, i)
-                ref = "{}_.E2.80.93_{}".format(tag.keys["description"].any.replace(" ", "_"),
-                                               iname.replace(" ", "_"))
+    @functools.cached_property
+    def item_index(self):
+        item_index = {}
+        for name, sort in self.items:
+            item_index[name.lower()] = "{}_.E2.80.93_{}".format(name, writer.sort_translations.get(sort, sort))
+        self.items = None
+        return item_index
+
+    @functools.cached_property
+    def ability_index(self):
+        ability_index = {}
+        for macro_name, name, type in self.abilities:
+            ability_index[macro_name] = "{}_.E2.80.93_{}".format(name, type)
+        self.abilities = None
+        return ability_index
+
+    @functools.cached_property
+    def advancement_index(self):
+        # Advancements with the same description and name get ref, ref_2,
+        # ref_3 and so on. suffixes remembers where the search for the next
+        # free one of each ref can start, as all before it are taken.
+        advancement_index = {}
+        self.advancement_urls = set()
+        suffixes = {}
+        for section, name, description in self.advancements:
+            ref = "{}_.E2.80.93_{}".format(description.replace(" ", "_"), name.replace(" ", "_"))
+            i = suffixes.get(ref, 1)
+            url = ref if i == 1 else "{}_{}".format(ref, i)
+            while url in self.advancement_urls:
                 i += 1
-            self.advancement_urls.add(ref)
-            self.advancement_index[section + name.lower()] = ref
+                url = "{}_{}".format(ref, i)
+            suffixes[ref] = i + 1
+            self.advancement_urls.add(url)
+            advancement_index[section + name.lower()] = url
+        self.advancements = None
+        return advancement_index
+
+    def table(self, kind):
+        # The anchors of a kind by normalized key: lower case item names,
+        # ability macros and section + lower case advancement names
+        return getattr(self, kind + "_index")
+
+    def anchor(self, kind, section, name):
+        # The anchor of an item or advancement, or None. Misses are reported
+        # by the Links of the page instead.
+        if kind == "item":
+            return self.item_index.get(name.lower())
+        return self.advancement_index.get(section + name.lower())
+
+
+class Links:
+    # The links of one page to items, abilities and advancements. While the
+    # page is written each is left in the text as a placeholder, and once
+    # it's done they are all looked up at once, and those that can't be
+    # found reported together. graph gives what each advancement requires,
+    # and preprocessor expands the macros the writer has no name for.
+    placeholder = re.compile("\0([0-9]+)\0")
 
-    def query_advancement(self, section, name):
-        if section + name.lower() in self.advancement_index:
-            return self.advancement_index[section + name.lower()]
-        if self.verbose:
-            print("BUG DETECT: Could not find advancement", name, "in", section)
+    def __init__(self, idx, page, graph=None, preprocessor=None):
+        self.idx = idx
+        self.page = page
+        self.graph = graph
+        self.preprocessor = preprocessor
+        self.copies = collections.Counter()
+        self.links = []
+        self.resolved = None
 
-    def query_item(self, item_name):
-        if item_name in self.item_index:
-            return self.item_index[item_name]
-        if self.verbose:
-            print("BUG DETECT: Could not find item", item_name)
+    def link(self, kind, key, link, label, missing, what):
+        self.links.append((kind, key, link, label, missing, what))
+        return "\0{}\0".format(len(self.links) - 1)
+
+    def ability_link(self, ability_name, label):
+        return self.link("ability", ability_name, "[[LotI_Abilities#{}|{}]]", label, label, ability_name)
+
+    def advancement_link(self, section, name):
+        return self.link("advancement", section + name.lower(), "[[#{}|{}]]", name, name, "{} in {}".format(name, section))
+
+    def requirements(self, section, name):
+        # What the next copy of an advancement written on this page requires,
+        # linked where the section has it. Pages write the copies in the
+        # order the graph was given them.
+        copy = self.copies[section, name.lower()]
+        self.copies[section, name.lower()] += 1
+        return [
+            self.advancement_link(section, n) if self.graph.has(section, n) else n
+            for n in self.graph.requires(section, name, copy)
+        ]
 
     def process_requirement(self, item_name):
-        if self.query_item(item_name.lower()):
-            return "(requires [[#{}|{}]])".format(self.query_item(item_name.lower()), item_name)
-        else:
-            return "(requires {})".format(item_name)      
-        
-    def query_ability(self, ability_name):
-        if ability_name in self.ability_index:
-            return self.ability_index[ability_name]
-        if self.verbose:
-            print("BUG DETECT: Could not find ability", ability_name)
+        return self.link("item", item_name.lower(), "(requires [[#{}|{}]])", item_name, "(requires {})".format(item_name), item_name.lower())
+
+    def resolve(self):
+        anchors = {}
+        for kind, key, *_ in self.links:
+            if (kind, key) not in anchors:
+                anchors[kind, key] = self.idx.table(kind).get(key)
+        self.resolved = []
+        misses = collections.Counter()
+        for kind, key, link, label, missing, what in self.links:
+            anchor = anchors[kind, key]
+            if anchor:
+                self.resolved.append(link.format(anchor, label))
+            else:
+                self.resolved.append(missing)
+                misses[kind, what] += 1
+        if self.idx.verbose and misses:
+            print("BUG DETECT: Could not find {} of the links in {}:".format(sum(misses.values()), self.page))
+            for (kind, what), count in sorted(misses.items()):
+                print("BUG DETECT:     {} {}{}".format(kind, what, " ({} links)".format(count) if count > 1 else ""))
+
+    def sub(self, text):
+        # text with the placeholders replaced, once resolve has been called
+        return self.placeholder.sub(lambda m: self.resolved[int(m.group(1))], text)
+
+
+# Bumped whenever the tables change, older files are started afresh
+SCHEMA = 2
+
+
+def compress(block, zdict):
+    compressor = zlib.compressobj(9, zdict=zdict)
+    return compressor.compress(block) + compressor.flush()
+
+
+def save(path, version, pages, graph=None):
+    # Write the anchor and wiki text of each item and advancement to an
+    # SQLite file, for query to look up without a run. pages maps the title
+    # of each page written to its (kind, section, name, anchor, block) entries,
+    # which replace any the page had before. The blocks are short and much
+    # alike, so each page's are compressed with a dictionary sampled from
+    # them. If there is a graph, the chain of advancements each one requires
+    # replaces those saved before.
+    with contextlib.closing(sqlite3.connect(str(path))) as db:
+        with db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA:
+                db.execute("DROP TABLE IF EXISTS entities")
+                db.execute("DROP TABLE IF EXISTS pages")
+                db.execute("DROP TABLE IF EXISTS requirements")
+                db.execute("PRAGMA user_version = {}".format(SCHEMA))
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entities ("
+                "kind TEXT, section TEXT, name TEXT, page TEXT, anchor TEXT, block BLOB, "
+                "PRIMARY KEY (kind, section, name))"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS pages (page TEXT PRIMARY KEY, version TEXT, zdict BLOB)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS requirements ("
+                "section TEXT, name TEXT, step INTEGER, required TEXT, PRIMARY KEY (section, name, step))"
+            )
+            for page, entries in pages.items():
+                blocks = [block.encode() for *_, block in entries]
+                zdict = b"".join(blocks[:: max(1, len(blocks) // 64)])[-32768:]
+                db.execute("DELETE FROM entities WHERE page = ?", (page,))
+                db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (page, version, zdict))
+                db.executemany(
+                    "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (kind, section.lower(), name.lower(), page, anchor, compress(block, zdict))
+                        for (kind, section, name, anchor, _), block in zip(entries, blocks)
+                    ),
+                )
+            if graph is not None:
+                db.execute("DELETE FROM requirements")
+                db.executemany(
+                    "INSERT OR REPLACE INTO requirements VALUES (?, ?, ?, ?)",
+                    ((section.lower(), name.lower(), step, required) for section, name, step, required in graph.rows()),
+                )
+
+
+def lookup(path, kind, section, name):
+    # (page, anchor, block, version) of an entry in a file written by save,
+    # or None if there is no such entry. Raises sqlite3.Error if path isn't
+    # one.
+    uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+    with contextlib.closing(sqlite3.connect(uri, uri=True)) as db:
+        row = db.execute(
+            "SELECT entities.page, anchor, block, version, zdict FROM entities JOIN pages USING (page) "
+            "WHERE kind = ? AND section = ? AND name = ?",
+            (kind, section.lower(), name.lower()),
+        ).fetchone()
+    if row is None:
+        return None
+    page, anchor, block, version, zdict = row
+    return page, anchor, zlib.decompressobj(zdict=zdict).decompress(block).decode(), version
+
+
+def requirements(path, section, name):
+    # The names of the advancements that have to be taken before one, in an
+    # order they can be taken in, from a file written by save, or None if
+    # they require each other
+    uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+    with contextlib.closing(sqlite3.connect(uri, uri=True)) as db:
+        rows = db.execute(
+            "SELECT step, required FROM requirements WHERE section = ? AND name = ? ORDER BY step",
+            (section.lower(), name.lower()),
+        ).fetchall()
+    if rows and rows[0][0] is None:
+        return None
+    return [required for _, required in rows]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import re
+import shlex
+import threading
+import time
+
+from . import wml_parser
+
+define_regex = re.compile(
+    rb"^#define[ \t]+(\w+)([^\n]*)\n(.*?)^#enddef", re.MULTILINE + re.DOTALL
+)
+
+Define = collections.namedtuple("Define", ("args", "body", "filename", "lineno"))
+
+
+def macro_call(macro):
+    try:
+        return shlex.split(macro)
+    except ValueError:
+        return macro.split()
+
+
+class Preprocessor:
+    # The #defines of a LotI tree, expanded to token streams on demand.
+    # Expansions are memoized per (name, args), so a macro called the same
+    # way from many places is only expanded once.
+    def __init__(self, start, dirs=("utils", "macros")):
+        begin = time.perf_counter()
+        self.defines = {}
+        for dir in dirs:
+            for fname in sorted((start / dir).rglob("*.cfg")):
+                self.collect(fname.read_bytes(), fname)
+        self.memo = {}
+        self.expansions = self.reused = 0
+        # Pages are written by several threads with --jobs
+        self.lock = threading.Lock()
+        self.time = time.perf_counter() - begin
+
+    def collect(self, data, filename):
+        for m in define_regex.finditer(data):
+            self.defines[m.group(1).decode()] = Define(
+                m.group(2).decode().split(),
+                m.group(3),
+                str(filename),
+                data.count(b"\n", 0, m.start(3)) + 1,
+            )
+
+    def expand(self, name, args=()):
+        # The line index and tokens {name args} expands to, or None if it
+        # can't be expanded
+        with self.lock:
+            begin = time.perf_counter()
+            try:
+                return self.substitute(name, tuple(args), ())
+            finally:
+                self.time += time.perf_counter() - begin
+
+    def substitute(self, name, args, active):
+        key = name, args
+        if key in self.memo:
+            self.reused += 1
+            return self.memo[key]
+        define = self.defines.get(name)
+        if define is None or len(args) != len(define.args) or name in active:
+            return None
+        body = define.body
+        for arg, value in zip(define.args, args):
+            body = body.replace(b"{" + arg.encode() + b"}", value.encode())
+        tokens = []
+        try:
+            lines, body_tokens = wml_parser.tokenize(
+                body, define.lineno, define.filename
+            )
+            for token in wml_parser.preprocess(body_tokens):
+                if token[0] == wml_parser.MACRO:
+                    call = macro_call(token[2][0])
+                    nested = (
+                        self.substitute(call[0], tuple(call[1:]), active + (name,))
+                        if call
+                        else None
+                    )
+                    if nested is not None:
+                        # Nested expansions are placed at the macro call
+                        tokens.extend((c, i, v, token[3]) for c, i, v, _ in nested[1])
+                        continue
+                tokens.append(token)
+            expansion = lines, tokens
+        except RuntimeError:
+            # Bodies that are fragments of a tag or string can only be
+            # expanded in place
+            expansion = None
+        self.expansions += 1
+        self.memo[key] = expansion
+        return expansion
+
+    def tag(self, name, args=()):
+        expansion = self.expand(name, args)
+        if expansion is None:
+            return None
+        lines, tokens = expansion
+        return wml_parser.subparse_wml(
+            iter(tokens), self.defines[name].filename, lines
+        )
+
+    def summary(self):
+        return "Preprocessor: {} macros, {} expansions ({} reused) in {:.2f}s".format(
+            len(self.defines), self.expansions, self.reused, self.time
+        )
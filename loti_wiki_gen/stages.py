@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Matthew Joyce
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import time
+
+# run is called with the values named in reads, and returns the value named
+# in produces, or a tuple of them if there are several
+Stage = collections.namedtuple("Stage", ("name", "reads", "produces", "run"))
+
+
+def check(stages):
+    producers = {}
+    for stage in stages:
+        for name in stage.produces:
+            if name in producers:
+                raise ValueError("{} is produced by both {} and {}".format(name, producers[name].name, stage.name))
+            producers[name] = stage
+    for stage in stages:
+        for name in stage.reads:
+            if name not in producers:
+                raise ValueError("{} reads {}, which no stage produces".format(stage.name, name))
+    return producers
+
+
+def needed(stages, names):
+    # The stages that produce names and those they read from, in the order
+    # given
+    producers = check(stages)
+    wanted = set()
+    todo = [producers[name] for name in names]
+    while todo:
+        stage = todo.pop()
+        if stage.name not in wanted:
+            wanted.add(stage.name)
+            todo.extend(producers[name] for name in stage.reads)
+    return [stage for stage in stages if stage.name in wanted]
+
+
+def call(stage, args):
+    begin = time.perf_counter()
+    result = stage.run(*args)
+    if len(stage.produces) == 1:
+        result = (result,)
+    return result, begin, time.perf_counter()
+
+
+def run_stages(stages, jobs=1, keep=None):
+    # Run every stage once all it reads has been produced, and return the
+    # values produced and the (start, end) times of each stage. With jobs
+    # other than 1 stages that are ready at the same time run in a pool of
+    # that many threads (0 for the default), otherwise the first of them in
+    # the order given runs next. If keep is given, only those values are
+    # returned, and the others are dropped as soon as every stage reading
+    # them has finished.
+    check(stages)
+    values = {}
+    times = {}
+    waiting = list(stages)
+    readers = collections.Counter(name for stage in stages for name in stage.reads)
+    begin = time.perf_counter()
+
+    def ready():
+        for stage in list(waiting):
+            if all(name in values for name in stage.reads):
+                waiting.remove(stage)
+                yield stage, [values[name] for name in stage.reads]
+
+    def finish(stage, result, start, end):
+        values.update(zip(stage.produces, result))
+        times[stage.name] = start - begin, end - begin
+        for name in stage.reads:
+            readers[name] -= 1
+        if keep is not None:
+            for name in stage.reads + stage.produces:
+                if not readers[name] and name not in keep:
+                    values.pop(name, None)
+
+    if jobs == 1:
+        while waiting:
+            stage, args = next(ready(), (None, None))
+            if stage is None:
+                break
+            finish(stage, *call(stage, args))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(jobs or None) as pool:
+            running = {}
+            while True:
+                for stage, args in ready():
+                    running[pool.submit(call, stage, args)] = stage
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), *future.result())
+    if waiting:
+        raise ValueError("Stages {} depend on each other".format(", ".join(stage.name for stage in waiting)))
+    return values, times
+
+
+def critical_path(stages, times):
+    # The chain of stages, each reading from the one before, that took the
+    # longest in total. However many jobs there are, a run can't be faster.
+    producers = check(stages)
+    paths = {}
+    for stage in sorted(stages, key=lambda stage: times[stage.name][1]):
+        start, end = times[stage.name]
+        before = max((paths[producers[name].name] for name in stage.reads), default=(0, []))
+        paths[stage.name] = before[0] + end - start, before[1] + [stage.name]
+    return max(paths.values(), default=(0, []))
+
+
+def summary(stages, times):
+    total, path = critical_path(stages, times)
+    return "Stages: {:.2f}s, critical path {:.2f}s: {}".format(
+        max((end for _, end in times.values()), default=0),
+        total,
+        " -> ".join("{} {:.2f}s".format(name, times[name][1] - times[name][0]) for name in path),
+    )
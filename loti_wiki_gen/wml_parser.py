@@ -15,28 +15,229 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import itertools
+import mmap
+import os
 import re
+import sys
+import threading
+import time
 
 BUG_DETECT = False
+CACHE = None
+JOBS = 1
+# Files at least this big are tokenized in chunks on JOBS processes, and
+# are cached region by region, each region being about REGION_SIZE
+PARALLEL_SIZE = 256 * 1024
+REGION_SIZE = 64 * 1024
+# Seconds a file may take to parse before giving up on it, or None. The
+# clock is checked every BUDGET_STEP bytes.
+TIME_BUDGET = 60
+BUDGET_STEP = 64 * 1024
+# The #ifdef symbol and tag name registries are all that parses in
+# different threads share, so only adding to them is locked
+lock = threading.Lock()
 
 
+def reset_lock():
+    # A process forked while another thread was registering a name starts
+    # unlocked
+    global lock
+    lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_lock)
+
+
+# Every pattern has at most one way to match any text, so a failed attempt
+# costs no more than the text it looked at. A value runs from its first
+# non-space character to the end of the line, and swallows any blank lines
+# after it. If there is no such line, the value is the last space or tab
+# before a newline, as the backtracking patterns used to find.
 wml_regexes = [
-    ("key", r"([\w{}]+)\s*=\s*_?\s*\"([^\"]*)\""),
-    ("key", r"([\w{}]+)\s*=\s*([^\n]+)\s*\n"),
-    ("keys", r"([\w,]+)\s*=\s*([^\n]+)\s*\n"),
+    ("key", r"([\w{}]+)\s*=\s*(?:_\s*)?\"([^\"]*)\""),
+    ("key", r"([\w{}]+)\s*=\s*(\S[^\n]*)\n(?:\s*\n)?"),
+    ("key", r"([\w{}]+)\s*=\s*([^\S\n])\n(?:\s*\n)?"),
+    ("keys", r"([\w,]+)\s*=\s*(\S[^\n]*)\n(?:\s*\n)?"),
+    ("keys", r"([\w,]+)\s*=\s*([^\S\n])\n(?:\s*\n)?"),
     ("open", r"\[\+?([\w{}]+)\]"),
     ("close", r"\[/([\w{}]+)\]"),
     ("macro_open", r"(\{[^{}]+)"),
     ("pre", r"#(define|ifdef|else|endif|enddef|ifver) ?([^\n]*)"),
     ("whitespace", r"(\s+)"),
     ("comment", r"#[^\n]*"),
-    ("text", r"_?\s*\"(.*?)\""),
+    ("text", r"_?\s*\"([^\"]*)\""),
 ]
 
 levels = ["EASY", "MEDIUM", "HARD"]
 
-wml_regexes = [(n, re.compile(r, re.DOTALL)) for n, r in wml_regexes]
+# Annotations are bitmasks over the #ifdef symbols seen so far this run. The
+# difficulty levels are registered first, so they always get the low bits.
+symbols = {}
+
+
+def symbol_mask(name):
+    mask = symbols.get(name)
+    if mask is None:
+        with lock:
+            mask = symbols.get(name)
+            if mask is None:
+                mask = symbols[name] = 1 << len(symbols)
+    return mask
+
+
+def symbol_items():
+    # (name, bit) of every symbol registered so far
+    with lock:
+        return list(symbols.items())
+
+
+def register_symbols(names):
+    # Reproduce another registry, which has to start the same way as this one
+    for name in names:
+        symbol_mask(name)
+
+
+def mask_names(mask):
+    # The levels in order and then the other symbols by name, so the names
+    # don't depend on which file happened to be parsed first
+    return [name for name in levels if mask & symbols[name]] + sorted(
+        name for name, bit in symbol_items() if mask & bit and name not in levels
+    )
+
+
+def tree_symbols(tag):
+    # (name, bit) of each symbol, other than the levels, that the
+    # annotations of a tree use
+    mask = 0
+    todo = [tag]
+    while todo:
+        tag = todo.pop()
+        mask |= tag.annotation
+        for macro in tag.macros:
+            mask |= macro.annotation
+        for tags in tag.tags.values():
+            # The special notes keep their text under "text"
+            if isinstance(tags, list):
+                todo.extend(tags)
+    return [(name, bit) for name, bit in symbol_items() if mask & bit & ~LEVELS]
+
+
+def symbol_moves(pairs):
+    # {bit there: bit here} for the (name, bit) symbols of another registry
+    # that have different bits in this one, registering any that are new
+    moves = {}
+    for name, bit in pairs:
+        mask = symbol_mask(name)
+        if mask != bit:
+            moves[bit] = mask
+    return moves
+
+
+def move_mask(mask, moves):
+    moved = mask
+    for old in moves:
+        moved &= ~old
+    for old, new in moves.items():
+        if mask & old:
+            moved |= new
+    return moved
+
+
+def move_symbols(tag, moves, shift=0):
+    # A copy of a tree made with another registry, with its annotations
+    # moved to the bits of this one and its line numbers moved by shift
+    macros = []
+    for macro in tag.macros:
+        mv = MacroString(macro)
+        mv.annotation = move_mask(macro.annotation, moves)
+        macros.append(mv)
+    tags = {
+        name: [move_symbols(t, moves, shift) for t in tags]
+        if isinstance(tags, list)
+        else tags
+        for name, tags in tag.tags.items()
+    }
+    filename = tag.filename
+    if shift:
+        filename, lineno = filename.rsplit(":", 1)
+        filename = "{}:{}".format(filename, int(lineno) + shift)
+    return WMLTag(
+        tag.keys,
+        WMLTags(tags),
+        move_mask(tag.annotation, moves),
+        tuple(macros),
+        filename,
+    )
+
+
+register_symbols(levels)
+LEVELS = (1 << len(levels)) - 1
+
+
+def compile_scanner(regexes):
+    # All the token patterns as one alternation, tried in order at each
+    # position. Each pattern is wrapped in an outer group so that lastindex
+    # tells us which one matched and where its own groups start. The
+    # scanner works on the raw UTF-8 bytes of the file.
+    pattern = []
+    types = {}
+    index = 1
+    for type, regex in regexes:
+        ngroups = re.compile(regex).groups
+        types[index] = type, index, index + ngroups
+        pattern.append("({})".format(regex))
+        index += ngroups + 1
+    return re.compile("|".join(pattern).encode(), re.DOTALL), types
+
+
+wml_scanner, wml_scanner_types = compile_scanner(wml_regexes)
+# Macros next to each other, like {A}{B}{C}, make one long run of name
+# characters. If no key starts at the first macro none starts at the others,
+# so the rest of the run is scanned without the key patterns instead of
+# being looked through again from every macro.
+keyless_scanner, keyless_scanner_types = compile_scanner(
+    [(type, regex) for type, regex in wml_regexes if type != "key"]
+)
+name_run = re.compile(rb"[\w{}]+")
+macro_braces = re.compile(rb"[{}]")
+newline = re.compile(rb"\n")
+whitespace = b" \t\n\r\x0b\x0c"
+
+# (pattern, guard, anchor, replacement)
+#
+# The guard is the rest of the pattern after its leading string quote or
+# macro and starts with a rare character, so it is cheap to search for. The
+# anchor says how to find where the full match has to start from a guard hit.
+# The macros in a concatenation can't contain braces, so a search for the
+# end of one never runs past the next macro.
+macro_transforms = [
+    (r"\"\s*\+\s*\{([^{}]*)\}\s*\+\s*(?:_\s*)?\"", r"\+\s*\{[^{}]*\}\s*\+\s*(?:_\s*)?\"", '"', "\\1"),
+    (r"\{([^{}]*)\}\s*\+\s*(?:_\s*)?\"", r"\}\s*\+\s*(?:_\s*)?\"", "{", '"\\1'),
+    (r"\"\s*\+\s*\{([^{}]*)\}", r"\+\s*\{[^{}]*\}", '"', '\\1"'),
+    (r"\"\s*\+\s*(\d+)", r"\+\s*\d+", '"', '\\1"'),
+    (r"\"\s*\+\s*(?:_\s*)?\"", r"\+\s*(?:_\s*)?\"", '"', ""),
+    (r"\"\s*\+\s*\$(\S+)", r"\+\s*\$\S+", '"', '\\1"'),
+    (r"<<(.*?)>>+", r"<<", "", '"\1"'),
+]
+
+# The replacements only ever refer to group 1, so split them around it once
+# instead of having every match parse the template again
+macro_transforms = [
+    (
+        re.compile(r.encode(), re.MULTILINE + re.DOTALL),
+        re.compile(g.encode()),
+        a.encode(),
+        [part.encode() for part in s.split("\\1")],
+    )
+    for r, g, a, s in macro_transforms
+]
 
 
 WMLTag = collections.namedtuple(
@@ -45,8 +246,46 @@ WMLTag = collections.namedtuple(
 
 
 class WMLValue:
-    def __init__(self):
-        self.EASY = self.MEDIUM = self.HARD = ""
+    # Most keys are the same on every difficulty, so hold one shared string
+    # and only split it into (mask, value) pairs, one per distinct value,
+    # when they differ
+    __slots__ = ("value",)
+
+    def __init__(self, value=""):
+        self.value = value
+
+    def pairs(self):
+        if isinstance(self.value, str):
+            return ((LEVELS, self.value),)
+        return self.value
+
+    def get(self, index):
+        if isinstance(self.value, str):
+            return self.value
+        for mask, value in self.value:
+            if mask >> index & 1:
+                return value
+
+    def set(self, mask, value):
+        # Symbols that aren't difficulty levels don't select a value
+        mask &= LEVELS
+        if mask == LEVELS:
+            self.value = value
+            return
+        if not mask:
+            return
+        pairs = [(m & ~mask, v) for m, v in self.pairs() if m & ~mask]
+        for i, (m, v) in enumerate(pairs):
+            if v == value:
+                pairs[i] = m | mask, v
+                break
+        else:
+            pairs.append((mask, value))
+        self.value = pairs[0][1] if len(pairs) == 1 else tuple(pairs)
+
+    EASY = property(lambda self: self.get(0), lambda self, value: self.set(1, value))
+    MEDIUM = property(lambda self: self.get(1), lambda self, value: self.set(2, value))
+    HARD = property(lambda self: self.get(2), lambda self, value: self.set(4, value))
 
     @property
     def any(self):
@@ -56,16 +295,15 @@ class WMLValue:
 
     @property
     def all(self):
-        return self.EASY == self.MEDIUM == self.HARD
+        return isinstance(self.value, str)
 
     @all.setter
     def all(self, value):
-        self.EASY = self.MEDIUM = self.HARD = value
+        self.value = value
 
     def iter(self):
-        yield "EASY", self.EASY
-        yield "MEDIUM", self.MEDIUM
-        yield "HARD", self.HARD
+        for i, name in enumerate(levels):
+            yield name, self.get(i)
 
     def __repr__(self):
         return "WMLValue({!r}, {!r}, {!r})".format(self.EASY, self.MEDIUM, self.HARD)
@@ -102,67 +340,437 @@ class WMLValue:
                 pass
 
 
-def tokenize(text, lineno, filename):
-    macro_transforms = [
-        (r"\"\s*\+\s*\{([^}]*)\}\s*\+\s*_?\s*\"", "\\1"),
-        (r"\{([^}]*)\}\s*\+\s*_?\s*\"", '"\\1'),
-        (r"\"\s*\+\s*\{([^}]*)\}", '\\1"'),
-        (r"\"\s*\+\s*(\d+)", '\\1"'),
-        (r"\"\s*\+\s*_?\s*\"", ""),
-        (r"\"\s*\+\s*\$(\S+)", '\\1"'),
-        (r"<<(.*?)>>+", '"\1"'),
-    ]
-    for regex, sub in macro_transforms:
-        regex = re.compile(regex, re.MULTILINE + re.DOTALL)
-        while regex.search(text):
-            text = regex.sub(sub, text)
-    while text:
-        for type, regex in wml_regexes:
-            m = regex.match(text)
-            if m:
-                groups = m.groups()
-                text = text[m.end() :]
-                if type in ("whitespace", "comment"):
-                    pass
-                elif type == "keys":
-                    yield from (
-                        ("key", x, lineno)
-                        for x in zip(groups[0].split(","), groups[1].split(","))
-                    )
-                elif type == "macro_open":
-                    contents = groups[0]
-                    count = 1
-                    while count:
-                        c = text[0]
-                        if c == "{":
-                            count += 1
-                        if c == "}":
-                            count -= 1
-                        contents += c
-                        text = text[1:]
-                    yield "macro", (contents[1:-1],), lineno
-                else:
-                    yield type, groups, lineno
-                lineno += m.group(0).count("\n")
+def read_only(self, *args, **kwargs):
+    raise TypeError("Parsed WML can't be changed")
+
+
+class FrozenWMLValue(WMLValue):
+    # The values of parsed tags. They are built up as WMLValues and frozen
+    # when their tag closes; with_keys makes copies with other values.
+    __slots__ = ()
+
+    def __init__(self, value=""):
+        object.__setattr__(self, "value", value)
+
+    __setattr__ = set = read_only
+    all = property(WMLValue.all.fget, read_only)
+
+    def __reduce__(self):
+        if self is EMPTY:
+            return "EMPTY"
+        return FrozenWMLValue, (self.value,)
+
+
+# What a key that isn't there reads as
+EMPTY = FrozenWMLValue()
+
+
+class FrozenDict(dict):
+    # The keys or tags of a parsed tag. Missing entries read as default
+    # without being inserted, so looking things up never grows the tree.
+    __slots__ = ()
+    default = None
+
+    def __missing__(self, name):
+        return self.default
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+
+class WMLKeys(FrozenDict):
+    __slots__ = ()
+    default = EMPTY
+
+
+class WMLTags(FrozenDict):
+    __slots__ = ()
+    default = ()
+
+
+def with_keys(tag, **values):
+    # A copy of a parsed tag with some keys set to plain strings
+    keys = dict(tag.keys)
+    for name, value in values.items():
+        keys[sys.intern(name)] = FrozenWMLValue(value)
+    return WMLTag(WMLKeys(keys), tag.tags, tag.annotation, tag.macros, tag.filename)
+
+
+def guarded_subn(regex, guard, anchor, sub, text):
+    # Same result as regex.subn(sub, text), but only tries the pattern where
+    # the guard matches instead of at every quote in the file
+    pieces = []
+    last = pos = n = 0
+    while True:
+        hit = guard.search(text, pos)
+        if not hit:
+            break
+        start = hit.start()
+        if anchor == b'"':
+            p = start - 1
+            while p >= last and text[p] in whitespace:
+                p -= 1
+            if p < last or text[p] != ord('"'):
+                p = -1
+        elif anchor == b"{":
+            p = text.find(b"{", max(last, text.rfind(b"}", 0, start) + 1), start)
+        else:
+            p = start
+        m = regex.match(text, p) if p >= 0 else None
+        if not m:
+            if not anchor:
+                # Only <<...>> has no anchor, and if there is no >> after
+                # this << there is none after the next one either
                 break
+            pos = start + 1
+            continue
+        pieces.append(text[last:p])
+        pieces.append(m.group(1).join(sub) if len(sub) > 1 else sub[0])
+        last = pos = m.end()
+        n += 1
+    if not n:
+        return text, 0
+    pieces.append(text[last:])
+    return b"".join(pieces), n
+
+
+def rewrite_macros(text):
+    # Apply each transform until it stops matching, in order. Passes after
+    # the first are only needed for chains like "a" + {B} + {C}.
+    for transform in macro_transforms:
+        n = 1
+        while n:
+            text, n = guarded_subn(*transform, text)
+    return text
+
+
+# Tokens are (code, id, value, offset) tuples. The code is one of the type
+# codes below, with #define and #enddef getting codes of their own, and id
+# is the id of the name of a [tag], [/tag] or #define in tag_names, so
+# following the tag structure only compares integers. The value of a [tag]
+# or [/tag] is None, every other value is the tuple of what the token
+# pattern matched.
+KEY, OPEN, CLOSE, MACRO, PRE, TEXT, DEFINE, ENDDEF = range(8)
+# Stands for the tags of a whole region in the tokens spliced_tree builds from
+SPLICE = 8
+token_codes = {"key": KEY, "open": OPEN, "close": CLOSE, "macro": MACRO, "text": TEXT}
+
+# The ids are handed out as names are first seen, so they are only
+# meaningful within one process
+tag_names = []
+tag_ids = {}
+
+
+def tag_id(name):
+    id = tag_ids.get(name)
+    if id is None:
+        with lock:
+            id = tag_ids.get(name)
+            if id is None:
+                tag_names.append(sys.intern(name))
+                id = tag_ids[name] = len(tag_names) - 1
+    return id
+
+
+def pre_token(value, offset):
+    if value[0] == "define":
+        return DEFINE, tag_id(value[1].split()[0]), value, offset
+    if value[0] == "enddef":
+        return ENDDEF, -1, value, offset
+    return PRE, -1, value, offset
+
+
+class TokenBuffer:
+    # A list of tokens kept as parallel arrays of their codes, ids, values
+    # and offsets. When pickled, the names of the ids go along and are
+    # given the ids of the process the buffer is loaded in.
+    __slots__ = ("types", "ids", "values", "offsets")
+
+    def __init__(self, tokens=()):
+        self.types = array.array("B")
+        self.ids = array.array("i")
+        self.values = []
+        self.offsets = array.array("I")
+        for token in tokens:
+            self.append(*token)
+
+    def append(self, code, id, value, offset):
+        self.types.append(code)
+        self.ids.append(id)
+        self.values.append(value)
+        self.offsets.append(offset)
+
+    def extend(self, other, shift=0):
+        # Append the tokens of another buffer, moving their offsets by shift
+        self.types.extend(other.types)
+        self.ids.extend(other.ids)
+        self.values.extend(other.values)
+        self.offsets.extend(offset + shift for offset in other.offsets)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        return zip(self.types, self.ids, self.values, self.offsets)
+
+    def __getstate__(self):
+        used = sorted(set(self.ids) - {-1})
+        local = {id: i for i, id in enumerate(used)}
+        ids = array.array("i", (local.get(id, -1) for id in self.ids))
+        return self.types, ids, [tag_names[id] for id in used], self.values, self.offsets
+
+    def __setstate__(self, state):
+        self.types, ids, names, self.values, self.offsets = state
+        ids_here = [tag_id(name) for name in names]
+        self.ids = array.array("i", (-1 if id < 0 else ids_here[id] for id in ids))
+
+
+class LineIndex:
+    # Line numbers of offsets into text, found by bisecting the offsets of
+    # its newlines. Those are only collected the first time they are needed.
+    __slots__ = ("text", "first", "newlines")
+
+    def __init__(self, text, first):
+        self.text = text
+        self.first = first
+        self.newlines = None
+
+    def build(self):
+        if self.newlines is None:
+            self.newlines = [m.start() for m in newline.finditer(self.text)]
+            self.text = None
+
+    def __call__(self, offset):
+        self.build()
+        return self.first + bisect.bisect_left(self.newlines, offset)
+
+
+def budget_deadline():
+    return None if TIME_BUDGET is None else time.perf_counter() + TIME_BUDGET
+
+
+def over_budget(deadline, filename, lines, pos):
+    if time.perf_counter() > deadline:
+        raise RuntimeError(
+            "Gave up on {}:{} after {}s of parsing (see --time-budget)".format(
+                filename, lines(pos), TIME_BUDGET
+            )
+        )
+
+
+def tokenize(text, lineno, filename, skipping=None, regions=False):
+    # The line index of the rewritten text and its tokens, which carry
+    # offsets into it. While skipping[0] is set, only the tokens needed to
+    # follow the tag structure are decoded and yielded. regions caches the
+    # tokens region by region, for iterparse; parse caches the tags built
+    # from each region instead (see spliced_tree).
+    deadline = budget_deadline()
+    text = rewrite_macros(text)
+    lines = LineIndex(text, lineno)
+    if regions and CACHE is not None and len(text) >= PARALLEL_SIZE:
+        tokens = tokenize_regions(text, filename)
+        if tokens is not None:
+            return lines, tokens
+    elif JOBS != 1 and len(text) >= PARALLEL_SIZE:
+        tokens = tokenize_parallel(text, filename)
+        if tokens is not None:
+            return lines, tokens
+    return lines, scan(text, 0, len(text), lines, filename, skipping, deadline)
+
+
+def scan(text, pos, end, lines, filename, skipping=None, deadline=None):
+    # Tokens from pos until the first token boundary at or after end,
+    # returning where that is
+    keyless = check = pos
+    while pos < end:
+        if deadline is not None and pos >= check:
+            over_budget(deadline, filename, lines, pos)
+            check = pos + BUDGET_STEP
+        if pos < keyless:
+            m = keyless_scanner.match(text, pos)
+            types = keyless_scanner_types
         else:
+            m = wml_scanner.match(text, pos)
+            types = wml_scanner_types
+        if not m:
             raise RuntimeError(
-                "Can't parse {} at {}:{}".format(repr(text[:100]), filename, lineno)
+                "Can't parse {} at {}:{}".format(
+                    repr(text[pos : pos + 100].decode("utf-8", "replace")),
+                    filename,
+                    lines(pos),
+                )
+            )
+        type, first, last = types[m.lastindex]
+        offset = pos
+        pos = m.end()
+        if type in ("whitespace", "comment"):
+            pass
+        elif skipping and skipping[0] and type in ("key", "keys", "text"):
+            pass
+        elif type == "keys":
+            names, values = m.groups()[first:last]
+            yield from (
+                (KEY, -1, x, offset)
+                for x in zip(names.decode().split(","), values.decode().split(","))
+            )
+        elif type == "macro_open":
+            if offset >= keyless:
+                keyless = name_run.match(text, offset).end()
+            count = 1
+            for brace in macro_braces.finditer(text, pos):
+                count += 1 if brace.group() == b"{" else -1
+                if not count:
+                    break
+            else:
+                raise RuntimeError(
+                    "Unterminated macro {} at {}:{}".format(
+                        repr(text[offset : offset + 100].decode("utf-8", "replace")),
+                        filename,
+                        lines(offset),
+                    )
+                )
+            pos = brace.end()
+            if not (skipping and skipping[0]):
+                yield MACRO, -1, (text[offset + 1 : brace.start()].decode(),), offset
+        elif type == "open" or type == "close":
+            yield token_codes[type], tag_id(m.group(first + 1).decode()), None, offset
+        elif type == "pre":
+            yield pre_token(tuple(g.decode() for g in m.groups()[first:last]), offset)
+        else:
+            yield token_codes[type], -1, tuple(g.decode() for g in m.groups()[first:last]), offset
+    return pos
+
+
+chunk_boundary = re.compile(rb"\n[ \t]*(?=\[object\]|#define[ \t])")
+chunk_text = None
+
+
+def split_points(text, chunks):
+    # Offsets of [object]s and #defines that cut text into about chunks
+    # pieces, leaving out any that an odd number of quotes before them puts
+    # inside a string
+    step = len(text) // chunks
+    points = [0]
+    checked = odd = 0
+    for m in chunk_boundary.finditer(text):
+        pos = m.end()
+        if pos - points[-1] < step:
+            continue
+        odd ^= text.count(b'"', checked, pos) % 2
+        checked = pos
+        if not odd:
+            points.append(pos)
+    points.append(len(text))
+    return points
+
+
+def set_chunk_text(text):
+    global chunk_text
+    chunk_text = text
+
+
+def scan_tokens(text, start, end, filename):
+    # A TokenBuffer of the tokens from start with their offsets counted from
+    # there, and where scanning stopped
+    tokens = TokenBuffer()
+    scanner = scan(
+        text, start, end, LineIndex(text, 1), filename, None, budget_deadline()
+    )
+    while True:
+        try:
+            code, id, value, offset = next(scanner)
+        except StopIteration as stop:
+            return tokens, stop.value
+        tokens.append(code, id, value, offset - start)
+
+
+def scan_chunk(start, end, filename):
+    return scan_tokens(chunk_text, start, end, filename)
+
+
+def scan_spans(text, spans, filename):
+    # scan_tokens for each (start, end) in spans, on JOBS processes if there
+    # is enough to scan. Each worker is sent the whole text once.
+    if JOBS != 1 and sum(end - start for start, end in spans) >= PARALLEL_SIZE:
+        with concurrent.futures.ProcessPoolExecutor(
+            JOBS or None, initializer=set_chunk_text, initargs=(bytes(text),)
+        ) as pool:
+            return list(
+                pool.map(
+                    scan_chunk,
+                    [start for start, end in spans],
+                    [end for start, end in spans],
+                    itertools.repeat(str(filename)),
+                )
             )
+    return [scan_tokens(text, start, end, filename) for start, end in spans]
+
+
+def join_chunks(chunks, starts):
+    tokens = TokenBuffer()
+    for chunk, start in zip(chunks, starts):
+        tokens.extend(chunk, start)
+    return tokens
+
+
+def tokenize_parallel(text, filename):
+    # Scan chunks of text on several processes. A chunk is scanned on past
+    # its end if a token crosses it, so it only lines up with the next
+    # chunk if its end is a real token boundary. If any chunk doesn't, or a
+    # chunk fails, this returns None and the caller scans serially.
+    points = split_points(text, (JOBS or os.cpu_count() or 1) * 4)
+    if len(points) < 3:
+        return None
+    spans = list(zip(points, points[1:]))
+    try:
+        chunks = scan_spans(text, spans, filename)
+    except (RuntimeError, ValueError, OSError):
+        return None
+    for (tokens, end), (start, point) in zip(chunks, spans):
+        if end != point:
+            return None
+    return join_chunks([tokens for tokens, end in chunks], points)
+
+
+def tokenize_regions(text, filename):
+    # Like tokenize_parallel, but the text is cut into small regions and
+    # the tokens of each are cached by its contents, so an edit to a big
+    # file only rescans the regions it touched. A region is only stored if
+    # scanning it stopped exactly at its end. Every cut is followed by an
+    # [object] or #define, so the tokens of a region never depend on what
+    # comes after it.
+    points = split_points(text, max(len(text) // REGION_SIZE, 1))
+    spans = list(zip(points, points[1:]))
+    keys = [CACHE.key(text[start:end], "region") for start, end in spans]
+    chunks = [CACHE.load(key) for key in keys]
+    missing = [i for i, chunk in enumerate(chunks) if chunk is None]
+    try:
+        scanned = scan_spans(text, [spans[i] for i in missing], filename)
+    except (RuntimeError, ValueError, OSError):
+        return None
+    for i, (tokens, end) in zip(missing, scanned):
+        if end != spans[i][1]:
+            return None
+        chunks[i] = tokens
+        CACHE.put(keys[i], tokens)
+    return join_chunks(chunks, points)
 
 
 def preprocess(tokens):
     tokens = iter(tokens)
-    for type, value, lineno in tokens:
-        if type == "pre" and value[0] == "ifver":
+    for token in tokens:
+        if token[0] == PRE and token[2][0] == "ifver":
             nt = next(tokens)
-            while nt[:2] != ("pre", ("else", "")):
+            while nt[0] != PRE or nt[2] != ("else", ""):
                 yield nt
                 nt = next(tokens)
-            while nt[:2] != ("pre", ("endif", "")):
+            while nt[0] != PRE or nt[2] != ("endif", ""):
                 nt = next(tokens)
         else:
-            yield type, value, lineno
+            yield token
 
 
 def split(s):
@@ -172,82 +780,312 @@ def split(s):
 class MacroString(str): ...
 
 
-def subparse_wml(tokens, filename, first_lineno, tag_ann="all"):
-    keys = collections.defaultdict(WMLValue)
-    tags = collections.defaultdict(list)
-    macros = []
-    annotation = levels
-    tokens = iter(tokens)
-    for type, value, lineno in tokens:
-        if type == "key":
-            name, value = value
-            if name == "increse_attacks":
-                name = "increase_attacks"
-            for l in annotation:
-                setattr(keys[name], l, value)
-            keys[name].verify(name, filename, lineno)
-        if type == "open":
-            subtokens = []
-            nt = next(tokens)
-            count = 0
-            while count or nt[:2] != ("close", (value[0],)):
-                if nt[:2] == ("open", (value[0],)):
-                    count += 1
-                if nt[:2] == ("close", (value[0],)):
-                    count -= 1
-                subtokens.append(nt)
-                try:
-                    nt = next(tokens)
-                except StopIteration:
+class OpenTag:
+    # A tag or #define that has been opened but not closed yet, with the id
+    # of its name (-1 for the root). balance is the number of unclosed
+    # [name] tags (of any depth) when it was opened.
+    __slots__ = (
+        "id",
+        "name",
+        "define",
+        "offset",
+        "tag_ann",
+        "balance",
+        "annotation",
+        "keys",
+        "tags",
+        "macros",
+        "select",
+    )
+
+    def __init__(self, id, define, offset, tag_ann, balance=0, select=None):
+        self.id = id
+        self.name = tag_names[id] if id >= 0 else None
+        self.define = define
+        self.offset = offset
+        self.tag_ann = tag_ann
+        self.balance = balance
+        self.select = select
+        self.annotation = LEVELS
+        self.keys = {}
+        self.tags = {}
+        self.macros = []
+
+    def key(self, name):
+        values = self.keys.get(name)
+        if values is None:
+            values = self.keys[sys.intern(name)] = WMLValue()
+        return values
+
+    def add_tag(self, name, tag):
+        tags = self.tags.get(name)
+        if tags is None:
+            tags = self.tags[sys.intern(name)] = []
+        tags.append(tag)
+
+    def tag(self, filename, lines):
+        for values in self.keys.values():
+            # Same layout, so no copy is needed
+            values.__class__ = FrozenWMLValue
+        return WMLTag(
+            WMLKeys(self.keys),
+            WMLTags(self.tags),
+            self.tag_ann,
+            tuple(self.macros),
+            "{}:{}".format(filename, lines(self.offset)),
+        )
+
+
+def close_tags(stack, index, filename, lines, eof=False):
+    # Close everything from stack[index] upwards. Only stack[index] has seen
+    # its closing token (unless we are at the end of the file), so any
+    # #define above it is unterminated.
+    for frame in stack[index if eof else index + 1 :]:
+        if frame.define:
+            raise RuntimeError("EOF while parsing macro {}".format(frame.name))
+    while len(stack) > index:
+        frame = stack.pop()
+        if frame.select is not False:
+            stack[-1].add_tag(frame.name, frame.tag(filename, lines))
+
+
+def compile_select(paths):
+    # Turn paths like "unit_type/advancement" into a tree of dicts keyed by
+    # the ids of the names. A tag on
+    # one of the paths has its keys and macros built but only the children
+    # that are also on a path, "**" stands for the whole subtree and None
+    # selects everything.
+    if paths is None:
+        return None
+    root = {}
+    for path in paths:
+        parent, name, node = None, None, root
+        for part in path.split("/"):
+            if part == "**":
+                if parent is None:
+                    return None
+                parent[name] = None
+                break
+            if node is None:
+                break
+            parent, name = node, tag_id(part)
+            node = node.setdefault(name, {})
+    return root
+
+
+def subselect(select, id):
+    # What to build of a child of a tag built with select, whose name has
+    # id. False means skipping it, only following its brackets.
+    if select is None or select is False:
+        return select
+    return select.get(id, False)
+
+
+def apply_token(frame, code, value, offset, filename, lines):
+    # Everything but the tokens that open and close tags and #defines only
+    # affects the innermost open one
+    if code == KEY:
+        name, value = value
+        if name == "increse_attacks":
+            name = "increase_attacks"
+        values = frame.key(name)
+        values.set(frame.annotation, value)
+        if BUG_DETECT:
+            values.verify(name, filename, lines(offset))
+    elif code == MACRO:
+        if value[0].startswith("QUANTITY "):
+            vs = split(value[0])
+            if len(vs) != 5:
+                raise ValueError(f"Cannot parse {vs}")
+            _, name, easy, medium, hard = vs
+            values = frame.key(name)
+            values.EASY = easy
+            values.MEDIUM = medium
+            values.HARD = hard
+            if BUG_DETECT:
+                values.verify(name, filename, lines(offset))
+        else:
+            mv = MacroString(value[0])
+            mv.annotation = frame.annotation
+            frame.macros.append(mv)
+    elif code == PRE:
+        if value[0] == "ifdef":
+            frame.annotation = symbol_mask(value[1].strip())
+        elif value[0] == "else":
+            frame.annotation = LEVELS & ~frame.annotation
+        elif value[0] == "endif":
+            frame.annotation = LEVELS
+    elif code == TEXT:
+        # text translations for the special notes in the abilities file
+        frame.tags["text"] = value
+
+
+class NotSealed(Exception):
+    pass
+
+
+def subparse_wml(
+    tokens, filename, lines, tag_ann=LEVELS, select=None, skipping=None, sealed=False
+):
+    # A [tag] ends at the first [/tag] that balances the [tag]s opened since,
+    # even if that leaves tags opened inside it unclosed, and a #define ends
+    # at the first #enddef. Anything still open when its parent ends is cut
+    # short there. skipping is shared with tokenize, which can leave out the
+    # contents of tags that select skips. Token offsets are turned into line
+    # numbers by lines.
+    #
+    # With sealed, NotSealed is raised unless the tokens would build the same
+    # tags inside any tag: they may not change the root itself, close what
+    # they didn't open, leave anything open or use #define and #enddef.
+    root = OpenTag(-1, False, 0, tag_ann, select=select)
+    stack = [root]
+    frame = root
+    balance = collections.Counter()
+    for code, id, value, offset in tokens:
+        if code == OPEN:
+            balance[id] += 1
+            frame = OpenTag(
+                id,
+                False,
+                offset,
+                frame.annotation,
+                balance[id],
+                subselect(frame.select, id),
+            )
+            stack.append(frame)
+            if skipping:
+                skipping[0] = frame.select is False
+        elif code == CLOSE:
+            for i in range(len(stack) - 1, 0, -1):
+                if stack[i].id == id and not stack[i].define:
+                    if stack[i].balance == balance[id]:
+                        close_tags(stack, i, filename, lines)
+                        frame = stack[-1]
+                        if skipping:
+                            skipping[0] = frame.select is False
                     break
-            try:
-                tag = subparse_wml(subtokens, filename, lineno, annotation)
-            except Exception as e:
-                print(subtokens)
-                print(filename, first_lineno)
-                print(e.__class__)
-                raise
             else:
-                tags[value[0]].append(tag)
-        if type == "close":
-            pass
-        if type == "macro":
-            if value[0].startswith("QUANTITY "):
-                vs = split(value[0])
-                if len(vs) != 5:
-                    raise ValueError(f"Cannot parse {vs}")
-                _, name, easy, medium, hard = vs
-                keys[name].EASY = easy
-                keys[name].MEDIUM = medium
-                keys[name].HARD = hard
-                keys[name].verify(name, filename, lineno)
+                if sealed:
+                    raise NotSealed()
+            balance[id] -= 1
+        elif code == DEFINE:
+            if sealed:
+                raise NotSealed()
+            frame = OpenTag(
+                id, True, offset, frame.annotation, 0, subselect(frame.select, id)
+            )
+            stack.append(frame)
+            if skipping:
+                skipping[0] = frame.select is False
+        elif code == ENDDEF:
+            if sealed:
+                raise NotSealed()
+            for i in range(1, len(stack)):
+                if stack[i].define:
+                    close_tags(stack, i, filename, lines)
+                    frame = stack[-1]
+                    if skipping:
+                        skipping[0] = frame.select is False
+                    break
+        elif code == SPLICE:
+            # The tags were built sealed inside a tag with no #ifdef in
+            # effect, so they only fit into another such tag. Anywhere else
+            # the tokens of the region follow instead.
+            tags, moved, refused = value
+            if frame.annotation == LEVELS and frame.select is None:
+                for name, tag in tags:
+                    frame.add_tag(name, tag)
+                balance.update(moved)
             else:
-                mv = MacroString(value[0])
-                mv.annotation = annotation
-                macros.append(mv)
-        if type == "pre":
-            if value[0] == "ifdef":
-                annotation = {value[1].strip()}
-            elif value[0] == "else":
-                annotation = set(levels) - set(annotation)
-            elif value[0] == "endif":
-                annotation = levels
-            elif value[0] == "define":
-                name = value[1].split()[0]
-                subtokens = []
-                nt = next(tokens)
-                while not (nt[0] == "pre" and nt[1][0] == "enddef"):
-                    subtokens.append(nt)
-                    try:
-                        nt = next(tokens)
-                    except StopIteration:
-                        raise RuntimeError("EOF while parsing macro {}".format(name))
-                tag = subparse_wml(subtokens, filename, lineno, annotation)
-                tags[name].append(tag)
-        if type == "text":
-            # text translations for the special notes in the abilities file
-            tags["text"] = value
-    return WMLTag(keys, tags, tag_ann, macros, "{}:{}".format(filename, first_lineno))
+                refused[0] = True
+        elif frame.select is not False:
+            if sealed and frame is root:
+                raise NotSealed()
+            apply_token(frame, code, value, offset, filename, lines)
+    if sealed and len(stack) > 1:
+        raise NotSealed()
+    close_tags(stack, 1, filename, lines, eof=True)
+    return root.tag(filename, lines)
+
+
+def wml_events(tokens, filename, lines, select):
+    # The events iterparse yields for tokens, closing tags by the same rules
+    # as subparse_wml. Frames with a select of None are built in full and
+    # handed over with their end_tag, everything else is only followed.
+    def close(index, eof=False):
+        for frame in stack[index if eof else index + 1 :]:
+            if frame.define:
+                raise RuntimeError("EOF while parsing macro {}".format(frame.name))
+        while len(stack) > index:
+            frame = stack.pop()
+            if frame.select is not None:
+                yield "end_tag", frame.name, None
+            elif stack[-1].select is not None:
+                yield "end_tag", frame.name, frame.tag(filename, lines)
+            else:
+                stack[-1].add_tag(frame.name, frame.tag(filename, lines))
+                yield "end_tag", frame.name, None
+
+    stack = [OpenTag(-1, False, 0, LEVELS, select=select)]
+    frame = stack[0]
+    balance = collections.Counter()
+    for code, id, value, offset in tokens:
+        if code == OPEN:
+            balance[id] += 1
+            frame = OpenTag(
+                id,
+                False,
+                offset,
+                frame.annotation,
+                balance[id],
+                subselect(frame.select, id),
+            )
+            stack.append(frame)
+            yield "start_tag", frame.name, frame.tag_ann
+        elif code == CLOSE:
+            for i in range(len(stack) - 1, 0, -1):
+                if stack[i].id == id and not stack[i].define:
+                    if stack[i].balance == balance[id]:
+                        yield from close(i)
+                        frame = stack[-1]
+                    break
+            balance[id] -= 1
+        elif code == DEFINE:
+            frame = OpenTag(
+                id, True, offset, frame.annotation, 0, subselect(frame.select, id)
+            )
+            stack.append(frame)
+            yield "define", frame.name, frame.tag_ann
+        elif code == ENDDEF:
+            for i in range(1, len(stack)):
+                if stack[i].define:
+                    yield from close(i)
+                    frame = stack[-1]
+                    break
+        elif frame.select is None:
+            apply_token(frame, code, value, offset, filename, lines)
+        elif code == KEY:
+            if BUG_DETECT:
+                # Kept only to be checked like the keys of a built tag
+                apply_token(frame, code, value, offset, filename, lines)
+            yield "key", value[0], value[1], frame.annotation
+        elif code == MACRO and value[0].startswith("QUANTITY "):
+            if BUG_DETECT:
+                apply_token(frame, code, value, offset, filename, lines)
+            vs = split(value[0])
+            if len(vs) != 5:
+                raise ValueError(f"Cannot parse {vs}")
+            for bit, level in zip((1, 2, 4), vs[2:]):
+                yield "key", vs[1], level, bit
+        elif code == MACRO:
+            mv = MacroString(value[0])
+            mv.annotation = frame.annotation
+            yield "macro", mv
+        elif code == TEXT:
+            yield "text", value
+        else:
+            apply_token(frame, code, value, offset, filename, lines)
+    yield from close(1, eof=True)
 
 
 def format_parsed(tag, level=0):
@@ -260,16 +1098,199 @@ def format_parsed(tag, level=0):
                 stuff.append("    " * level + key + " = " + value + " # " + name)
     for name, tags in tag.tags.items():
         for tag in tags:
-            if tag.annotation != "all":
-                stuff.append("    " * level + "# " + tag.annotation)
+            if tag.annotation != LEVELS:
+                stuff.append("    " * level + "# " + " ".join(mask_names(tag.annotation)))
             stuff.append("    " * level + "[{}]".format(name))
             stuff.append(format_parsed(tag, level=level + 1))
             stuff.append("    " * level + "[/{}]".format(name))
     return "\n".join(stuff)
 
 
-def parse(text, filename, lineno):
+@contextlib.contextmanager
+def source_data(source):
+    # source is either WML text or the path of a .cfg file, which is scanned
+    # through a read-only mmap instead of being decoded as a whole
+    if isinstance(source, str):
+        yield source.encode("utf-8")
+        return
+    with open(source, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data.find(b"\r") != -1:
+                # Reading in text mode used to translate these
+                data = data[:].replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            yield data
+
+
+def parse(source, filename=None, lineno=1, select=None):
+    # select is a list of tag paths to build, everything else is skipped
+    # (see compile_select)
+    if filename is None and not isinstance(source, str):
+        filename = source
+    with source_data(source) as data:
+        return parse_bytes(data, filename, lineno, select)
+
+
+def iterparse(source, filename=None, lineno=1, build=()):
+    # Stream a file as events instead of building its tree:
+    #
+    #   ("start_tag", name, annotation)   ("define", name, annotation)
+    #   ("key", name, value, annotation)  ("macro", macro)
+    #   ("text", value)                   ("end_tag", name, tag)
+    #
+    # end_tag closes the innermost [tag] or #define. The tags on the paths in
+    # build are built in full, without events for their contents, and
+    # handed over as the tag of their end_tag (None for all others). Nothing
+    # is kept once it has been yielded.
+    if filename is None and not isinstance(source, str):
+        filename = source
     print(" -> Parsing", filename)
+    select = compile_select([path + "/**" for path in build])
+    with source_data(source) as data:
+        lines, tokens = tokenize(data, lineno, filename, regions=True)
+        yield from wml_events(preprocess(tokens), str(filename), lines, select)
+
+
+def build_tree(data, filename, lineno, select):
+    select = compile_select(select)
+    skipping = [False]
+    lines, tokens = tokenize(data, lineno, filename, skipping)
     return subparse_wml(
-        preprocess(tokenize(text, lineno, filename)), str(filename), lineno
+        preprocess(tokens), str(filename), lines, select=select, skipping=skipping
+    )
+
+
+def region_tags(tokens, start, filename, lines):
+    # What spliced_tree caches for a region starting at start if its tokens
+    # build sealed, with any #ifver in it ended there: the tags they build
+    # as (name, tag) in order, how they change the balance of each tag
+    # name, the line the region starts on and the symbols the tags use.
+    # Otherwise None.
+    try:
+        # preprocess runs out of tokens inside an #ifver that isn't ended
+        tokens = list(preprocess(tokens))
+        tree = subparse_wml(tokens, filename, lines, sealed=True)
+    except (NotSealed, RuntimeError):
+        return None
+    moved = collections.Counter()
+    for code, id, value, offset in tokens:
+        if code == OPEN:
+            moved[id] += 1
+        elif code == CLOSE:
+            moved[id] -= 1
+    return (
+        [(name, tag) for name, tags in tree.tags.items() for tag in tags],
+        {tag_names[id]: count for id, count in moved.items() if count},
+        lines(start),
+        tree_symbols(tree),
+    )
+
+
+def spliced_tokens(text, spans, parts, filename):
+    # The tokens of text, with each sealed region as one SPLICE token unless
+    # an #ifver before it is still open, as preprocess would then treat the
+    # region differently than on its own. The tokens of a sealed region
+    # follow its SPLICE if subparse_wml refused it.
+    wanted = None
+    for (start, end), part in zip(spans, parts):
+        if not isinstance(part, TokenBuffer):
+            if wanted is None:
+                refused = [False]
+                yield SPLICE, -1, part + (refused,), start
+                if not refused[0]:
+                    continue
+            tokens, stop = scan_tokens(text, start, end, filename)
+            part = TokenBuffer()
+            part.extend(tokens, start)
+        for token in part:
+            # Follow preprocess: an #ifver goes on to its #else and then
+            # to its #endif
+            if token[0] == PRE:
+                if wanted is None:
+                    if token[2][0] == "ifver":
+                        wanted = ("else", "")
+                elif token[2] == wanted:
+                    wanted = ("endif", "") if wanted[0] == "else" else None
+            yield token
+
+
+def spliced_tree(data, filename, lineno):
+    # The tree of a big file, built from regions cached by their contents,
+    # so an edit only rebuilds the regions it touched. Regions are cut
+    # where [object]s and #defines start, and most of them only hold whole
+    # tags, which are cached built and spliced into the tree as they are.
+    # The others are cached as their tokens, with offsets from the start of
+    # the region. None if the regions can't be scanned on their own.
+    text = rewrite_macros(data)
+    lines = LineIndex(text, lineno)
+    filename = str(filename)
+    points = split_points(text, max(len(text) // REGION_SIZE, 1))
+    spans = list(zip(points, points[1:]))
+    keys = [CACHE.key(text[start:end], filename, "tags") for start, end in spans]
+    records = [CACHE.load(key) for key in keys]
+    missing = [i for i, record in enumerate(records) if record is None]
+    try:
+        scanned = scan_spans(text, [spans[i] for i in missing], filename)
+    except (RuntimeError, ValueError, OSError):
+        return None
+    for i, (tokens, stop) in zip(missing, scanned):
+        start, end = spans[i]
+        if stop != end:
+            return None
+        region = TokenBuffer()
+        region.extend(tokens, start)
+        records[i] = region_tags(region, start, filename, lines) or tokens
+        CACHE.put(keys[i], records[i])
+    CACHE.count(int(not missing), int(bool(missing)))
+    parts = []
+    for (start, end), record in zip(spans, records):
+        if isinstance(record, TokenBuffer):
+            parts.append(TokenBuffer())
+            parts[-1].extend(record, start)
+            continue
+        # Tags loaded from the cache may have been built with another
+        # registry, or further up or down the file
+        tags, moved, line, pairs = record
+        moves = symbol_moves(pairs)
+        shift = lines(start) - line
+        if moves or shift:
+            tags = [(name, move_symbols(tag, moves, shift)) for name, tag in tags]
+        parts.append((tags, {tag_id(name): count for name, count in moved.items()}))
+    return subparse_wml(
+        preprocess(spliced_tokens(text, spans, parts, filename)), filename, lines
+    )
+
+
+def parse_bytes(data, filename, lineno, select=None):
+    print(" -> Parsing", filename)
+    return cached_tree(data, filename, lineno, select)
+
+
+def cached_tree(data, filename, lineno, select):
+    # BUG_DETECT output comes from parsing, so it never reads from the cache
+    # and checks every key
+    if BUG_DETECT:
+        return build_tree(data, filename, lineno, None)
+    if CACHE is None:
+        return build_tree(data, filename, lineno, select)
+    if select is None and len(data) >= PARALLEL_SIZE:
+        tree = spliced_tree(data, filename, lineno)
+        if tree is not None:
+            return tree
+    # The masks in a tree are only meaningful with the registry it was
+    # parsed with, which depends on what was parsed before it, so the tree
+    # is stored with the bits of the symbols it uses and moved to this
+    # run's bits when it is loaded
+    key = CACHE.key(
+        data, filename, lineno, None if select is None else sorted(select)
     )
+    entry = CACHE.get(key)
+    if entry is None:
+        tree = build_tree(data, filename, lineno, select)
+        CACHE.put(key, (tree, tree_symbols(tree)))
+        return tree
+    tree, pairs = entry
+    moves = symbol_moves(pairs)
+    return move_symbols(tree, moves) if moves else tree
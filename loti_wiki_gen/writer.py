@@ -189,6 +189,21 @@ def item_key_sort(kv):
         return 11
 
 
+def expanded_name(index, macro, args):
+    # The name given by the first tag the macro expands to
+    if index.preprocessor is None:
+        return None
+    tag = index.preprocessor.tag(macro, args)
+    if tag is None:
+        return None
+    for name, tags in tag.tags.items():
+        if name != "text":
+            for t in tags:
+                if t.keys["name"].any:
+                    return t.keys["name"].any
+    return None
+
+
 def special_name(index, name, args):
     if name in special_translation:
         x = special_translation[name]
@@ -202,16 +217,17 @@ def special_name(index, name, args):
         x = "charge ({})".format(args[0])
     elif name in ("MASSIVE_MISSILE",):
         x = "{} ({})".format(name.replace("_", " ").lower(), args[0])
+    elif args:
+        x = expanded_name(index, "WEAPON_SPECIAL_" + name, args) or "{} ({})".format(
+            name.replace("_", " ").lower(), ", ".join(args)
+        )
     else:
-        assert not args, (name, args)
         x = name.replace("_", " ").lower()
-    url = index.query_ability("WEAPON_SPECIAL_" + name)
-    if url:
-        return "[[LotI_Abilities#{}|{}]]".format(url, x)
-    return x
+    return index.ability_link("WEAPON_SPECIAL_" + name, x)
 
 
 def ability_name(index, name, args):
+    macro_args = args
     args = [i.replace("_", "") for i in args]
     if name in ability_translation:
         x = ability_translation[name]
@@ -244,13 +260,13 @@ def ability_name(index, name, args):
         "ALL_DAMAGE_AURA",
     ):
         x = "{} ({})".format(name.replace("_", " ").lower(), args[0])
+    elif args:
+        x = expanded_name(index, "ABILITY_" + name, macro_args) or "{} ({})".format(
+            name.replace("_", " ").lower(), ", ".join(args)
+        )
     else:
-        assert not args, (name, args)
         x = name.replace("_", " ").lower()
-    url = index.query_ability("ABILITY_" + name)
-    if url:
-        return "[[LotI_Abilities#{}|{}]]".format(url, x)
-    return x
+    return index.ability_link("ABILITY_" + name, x)
 
 
 def writer(file):
@@ -718,16 +734,9 @@ def write_advancement(section, name, tag, file, index):
                 else "once"
             )
         )
-    if "require_amla" in keys and keys["require_amla"].any not in ["{LEGACY}", ""]:
-        amlas = [n.strip() for n in keys["require_amla"].any.split(",")]
-        amlas = utils.english_join(
-            (
-                "[[#{}|{}]]".format(index.query_advancement(section, n), n)
-                if index.query_advancement(section, n)
-                else n
-            )
-            for n in amlas
-        )
+    amlas = index.requirements(section, name)
+    if amlas:
+        amlas = utils.english_join(amlas)
         write(
             "<span style='color:#808080'><i>This advancement requires the advancement{} to be achieved first</i></span>".format(
                 amlas
@@ -1041,9 +1050,9 @@ def write_scenario(chapter, name, tag, file):
             drops.append((macro.split()[1:], macro.annotation))
         if macro.startswith("BEELZEBUB_SPAWN_POINT"):
             bsp.append(macro.split()[1:])
-    for (chance, chance_gem, weapons, bosses, enemies), levels in drops:
-        if set(levels) != set(wml_parser.levels):
-            write(f"On {' and '.join(levels)} difficulty:")
+    for (chance, chance_gem, weapons, bosses, enemies), mask in drops:
+        if mask != wml_parser.LEVELS:
+            write(f"On {' and '.join(wml_parser.mask_names(mask))} difficulty:")
         weapons = weapons.replace("(", "").replace(")", "").split(",")
         write(
             "<span style='color:green'>Chance of a dying enemy on the side"